@@ -0,0 +1,255 @@
+"""Progress backplane — 在多个 API 进程之间转发进度事件。
+
+ProgressHub 只持有本进程的 WebSocket 连接。多个 uvicorn worker（或多台机器）
+部署时，任务在 A 进程执行、客户端却连在 B 进程上，需要一条 backplane 把
+事件转发到其他进程：
+
+- local：单进程部署（默认），不做任何转发
+- sqlite：共享 SQLite outbox 表，各进程写入本进程事件并轮询其他进程的事件；
+  只依赖本机文件，同一台机器上的多个 worker 无需额外服务
+
+新的实现（如 Redis / NATS）继承 Backplane 并在 BACKPLANES 中注册即可，
+通过 PROGRESS_BACKPLANE 环境变量选择。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+from app.file_store import PROJECT_ROOT
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_BACKPLANE = os.getenv("PROGRESS_BACKPLANE", "local")
+# 默认放在项目根目录：各 worker 的工作目录不同也共用同一个 outbox
+PROGRESS_OUTBOX_PATH = os.getenv("PROGRESS_OUTBOX_PATH", str(PROJECT_ROOT / "progress_outbox.db"))
+# outbox 轮询间隔（秒）：同时决定本进程事件的批量写入频率与跨进程延迟
+PROGRESS_OUTBOX_POLL_INTERVAL = float(os.getenv("PROGRESS_OUTBOX_POLL_INTERVAL", "0.1"))
+# outbox 中事件的保留时间（秒），过期行定期删除
+PROGRESS_OUTBOX_RETENTION = float(os.getenv("PROGRESS_OUTBOX_RETENTION", "60"))
+# 待写入 outbox 的事件缓冲上限，写入持续失败时丢弃最旧的事件
+PROGRESS_OUTBOX_BUFFER_MAX = int(os.getenv("PROGRESS_OUTBOX_BUFFER_MAX", "10000"))
+
+# 收到其他进程事件时的回调：(payload, 已编码的 JSON 文本)
+Deliver = Callable[[dict, str], Awaitable[None]]
+
+
+class Backplane:
+    """跨进程事件转发接口。
+
+    publish() 只负责把本进程事件送往其他进程（本进程连接由 ProgressHub 直接推送）；
+    其他进程的事件通过 start() 传入的 deliver 回调交给本进程的 ProgressHub。
+    """
+
+    name = "local"
+    # 为 False 时 ProgressHub 跳过 publish（无订阅者时也不必编码）
+    remote = False
+
+    async def start(self, deliver: Deliver) -> None:
+        pass
+
+    async def publish(self, payload: dict, text: str) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    def stats(self) -> dict[str, Any]:
+        return {"backend": self.name}
+
+
+class LocalBackplane(Backplane):
+    """单进程部署：不转发。"""
+
+
+class SQLiteOutboxBackplane(Backplane):
+    """基于共享 SQLite outbox 表的转发。
+
+    publish() 只把事件放入内存缓冲；后台协程每隔 poll_interval 秒在专用线程中
+    批量写入缓冲的事件，并读取其他进程写入的新事件后交给 deliver。
+    """
+
+    name = "sqlite"
+    remote = True
+
+    def __init__(
+        self,
+        path: str = PROGRESS_OUTBOX_PATH,
+        *,
+        poll_interval: float = PROGRESS_OUTBOX_POLL_INTERVAL,
+        retention: float = PROGRESS_OUTBOX_RETENTION,
+        buffer_max: int = PROGRESS_OUTBOX_BUFFER_MAX,
+    ) -> None:
+        self._path = path
+        self._poll_interval = poll_interval
+        self._retention = retention
+        self._buffer_max = max(buffer_max, 1)
+        self._origin = uuid.uuid4().hex
+        # sqlite3 连接只在这一个线程中使用
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="progress-outbox")
+        self._conn: sqlite3.Connection | None = None
+        self._outgoing: list[tuple[str, str, float]] = []
+        self._last_id = 0
+        self._last_prune = 0.0
+        self._deliver: Deliver | None = None
+        self._task: asyncio.Task | None = None
+        self._stats = {
+            "published": 0, "written": 0, "received": 0, "pruned": 0, "errors": 0, "dropped": 0,
+        }
+
+    async def _call(self, fn: Callable[..., Any], *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _open(self) -> int:
+        conn = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS progress_outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " origin TEXT NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_progress_outbox_created_at"
+            " ON progress_outbox (created_at)"
+        )
+        self._conn = conn
+        # 只转发启动之后的事件
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM progress_outbox").fetchone()[0]
+
+    def _sync(self, outgoing: list[tuple[str, str, float]], last_id: int) -> list[tuple[int, str, str]]:
+        """写入本进程事件并读取 last_id 之后的全部事件（在 outbox 线程中执行）。"""
+        conn = self._conn
+        assert conn is not None
+        if outgoing:
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(
+                    "INSERT INTO progress_outbox (origin, payload, created_at) VALUES (?, ?, ?)",
+                    outgoing,
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                # 如 database is locked：回滚，避免连接停留在事务中导致之后每次 BEGIN 都失败
+                conn.rollback()
+                raise
+        return conn.execute(
+            "SELECT id, origin, payload FROM progress_outbox WHERE id > ? ORDER BY id LIMIT 1000",
+            (last_id,),
+        ).fetchall()
+
+    def _prune(self, before: float) -> int:
+        assert self._conn is not None
+        return self._conn.execute(
+            "DELETE FROM progress_outbox WHERE created_at < ?", (before,)
+        ).rowcount
+
+    async def start(self, deliver: Deliver) -> None:
+        if self._task is not None:
+            return
+        self._deliver = deliver
+        self._last_id = await self._call(self._open)
+        self._task = asyncio.create_task(self._poll_loop(), name="progress-outbox")
+        logger.info("进度 backplane: sqlite outbox %s", self._path)
+
+    async def publish(self, payload: dict, text: str) -> None:
+        self._outgoing.append((self._origin, text, time.time()))
+        self._stats["published"] += 1
+        self._trim()
+
+    def _trim(self) -> None:
+        """缓冲超过上限时丢弃最旧的事件（进度事件只有最新的有意义）。"""
+        overflow = len(self._outgoing) - self._buffer_max
+        if overflow > 0:
+            del self._outgoing[:overflow]
+            self._stats["dropped"] += overflow
+
+    async def _poll_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self._poll_interval)
+            try:
+                await self._poll_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self._stats["errors"] += 1
+                logger.exception("进度 outbox 同步失败")
+
+    async def _poll_once(self) -> None:
+        outgoing, self._outgoing = self._outgoing, []
+        try:
+            rows = await self._call(self._sync, outgoing, self._last_id)
+        except BaseException:
+            # 写入失败时放回缓冲，下次重试（超出上限的最旧事件被丢弃）
+            self._outgoing[:0] = outgoing
+            self._trim()
+            raise
+        self._stats["written"] += len(outgoing)
+
+        for row_id, origin, text in rows:
+            self._last_id = row_id
+            if origin == self._origin:
+                continue
+            try:
+                payload = json.loads(text)
+            except ValueError:
+                continue
+            self._stats["received"] += 1
+            if self._deliver is not None:
+                await self._deliver(payload, text)
+
+        now = time.time()
+        if now - self._last_prune >= self._retention:
+            self._last_prune = now
+            self._stats["pruned"] += await self._call(self._prune, now - self._retention)
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        # 写出剩余事件后关闭连接
+        try:
+            await self._poll_once()
+        except Exception:
+            logger.exception("进度 outbox 关闭前写入失败")
+        if self._conn is not None:
+            await self._call(self._conn.close)
+            self._conn = None
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "backend": self.name,
+            "origin": self._origin,
+            "last_id": self._last_id,
+            "buffered": len(self._outgoing),
+            **self._stats,
+        }
+
+
+BACKPLANES: dict[str, Callable[[], Backplane]] = {
+    "local": LocalBackplane,
+    "sqlite": SQLiteOutboxBackplane,
+}
+
+
+def create_backplane(name: str = PROGRESS_BACKPLANE) -> Backplane:
+    """按名称创建 backplane（PROGRESS_BACKPLANE 环境变量）。"""
+    try:
+        factory = BACKPLANES[name]
+    except KeyError:
+        raise ValueError(f"unknown progress backplane: {name}") from None
+    return factory()
@@ -10,21 +10,27 @@ Talks to the ComfyUI server (default http://127.0.0.1:8188) to:
 - ControlNet Union (InstantX)
 - BiRefNet 背景移除
 - txt2img / img2img
-- 批量生成（每帧独立调用）
+- 批量生成（latent batch，一个 prompt 渲染多帧）
 """
 
 from __future__ import annotations
 
 import asyncio
+import functools
 import json
 import logging
 import os
 import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Any
 
 import aiohttp
 
+from app import fileio
+from app.file_store import COMFYUI_INPUT_DIR, is_content_name, stage_input
+
 logger = logging.getLogger(__name__)
 
 COMFYUI_URL = os.getenv("COMFYUI_URL", "http://127.0.0.1:8188")
@@ -32,6 +38,16 @@ COMFYUI_OUTPUT_DIR = os.getenv(
     "COMFYUI_OUTPUT_DIR",
     str(Path(__file__).resolve().parent.parent.parent / "ComfyUI" / "output"),
 )
+# 结果获取方式：filesystem = 从本地挂载的 COMFYUI_OUTPUT_DIR 复制；
+# view = 经 ComfyUI /view 接口流式下载（ComfyUI 运行在其他机器上时使用）
+COMFYUI_RESULT_MODE = os.getenv("COMFYUI_RESULT_MODE", "filesystem")
+if COMFYUI_RESULT_MODE not in ("filesystem", "view"):
+    raise ValueError(f"unknown COMFYUI_RESULT_MODE: {COMFYUI_RESULT_MODE}")
+# 输入图片交给 ComfyUI 的方式：link = 硬链接到本机 ComfyUI/input；
+# upload = 经 /upload/image 上传到实际执行 prompt 的实例（按内容哈希缓存，不重复上传）
+COMFYUI_INPUT_MODE = os.getenv("COMFYUI_INPUT_MODE", "link")
+if COMFYUI_INPUT_MODE not in ("link", "upload"):
+    raise ValueError(f"unknown COMFYUI_INPUT_MODE: {COMFYUI_INPUT_MODE}")
 
 # ---------------------------------------------------------------------------
 #  Flux.1 Schnell 默认模型路径
@@ -43,6 +59,28 @@ FLUX_T5XXL = os.getenv("FLUX_T5XXL", "t5xxl_fp16.safetensors")
 FLUX_VAE = os.getenv("FLUX_VAE", "ae.safetensors")
 FLUX_CONTROLNET = os.getenv("FLUX_CONTROLNET", "instantx-flux-union-controlnet.safetensors")
 
+# ---------------------------------------------------------------------------
+#  抠图模型
+# ---------------------------------------------------------------------------
+
+# BackgroundRemovalCreate.model → RMBG 节点的 model 参数
+REMOVE_BG_MODELS: dict[str, str] = {
+    "birefnet": os.getenv("REMOVE_BG_MODEL", "BiRefNet"),
+    "birefnet-hr": os.getenv("REMOVE_BG_MODEL_HR", "BiRefNet-HR"),
+}
+DEFAULT_REMOVE_BG_MODEL = "birefnet"
+# model=auto 时长边超过该像素数的图片使用 HR 模型，其余（小尺寸 sprite 等）使用快速模型
+REMOVE_BG_AUTO_HR_SIDE = int(os.getenv("REMOVE_BG_AUTO_HR_SIDE", "1024"))
+
+
+def resolve_remove_bg_model(model: str, size: tuple[int, int] | None) -> str:
+    """把请求中的抠图模型解析为 REMOVE_BG_MODELS 的键；auto 按图片尺寸选择，尺寸未知时用快速模型。"""
+    if model in REMOVE_BG_MODELS:
+        return model
+    if size is not None and max(size) > REMOVE_BG_AUTO_HR_SIDE:
+        return "birefnet-hr"
+    return DEFAULT_REMOVE_BG_MODEL
+
 # ---------------------------------------------------------------------------
 #  ControlNet Union 类型映射（Flux.1 ControlNet Union）
 # ---------------------------------------------------------------------------
@@ -65,6 +103,15 @@ CONTROLNET_PREPROCESSOR_MAP: dict[str, str] = {
 }
 
 
+def controlnet_preprocess_params(control_type: str) -> dict[str, Any]:
+    """预处理器节点的参数（分辨率、canny 阈值），预览与生成共用，也是预处理图缓存键的一部分。"""
+    params: dict[str, Any] = {"resolution": 1024}
+    if control_type == "canny":
+        params["low_threshold"] = 100
+        params["high_threshold"] = 200
+    return params
+
+
 # ---------------------------------------------------------------------------
 #  节点 ID 计数器
 # ---------------------------------------------------------------------------
@@ -79,32 +126,68 @@ class _NodeIdCounter:
         return str(self._id)
 
 
+# ---------------------------------------------------------------------------
+#  工作流模板（结构编译一次，按帧只替换参数）
+# ---------------------------------------------------------------------------
+
+@dataclass(frozen=True)
+class _WorkflowTemplate:
+    """编译后的工作流模板：节点图 + 各可变参数所在的 (节点 ID, 输入名)。"""
+    graph: dict[str, dict]
+    slots: dict[str, tuple[tuple[str, str], ...]]
+
+    def render(self, **values: Any) -> dict:
+        """返回替换参数后的 workflow。
+
+        只复制被修改的节点，其余节点与模板共享引用，调用方不得原地修改返回值。
+        """
+        workflow = dict(self.graph)
+        patched: dict[str, dict] = {}
+        for name, value in values.items():
+            for node_id, key in self.slots.get(name, ()):
+                node = patched.get(node_id)
+                if node is None:
+                    src = self.graph[node_id]
+                    node = {"class_type": src["class_type"], "inputs": dict(src["inputs"])}
+                    patched[node_id] = node
+                    workflow[node_id] = node
+                node["inputs"][key] = value
+        return workflow
+
+
 # ---------------------------------------------------------------------------
 #  Flux.1 Schnell 工作流构建
 # ---------------------------------------------------------------------------
 
-def build_flux_workflow(
-    *,
-    prompt: str,
-    negative_prompt: str = "",
-    seed: int,
-    controlnet: dict | None = None,
-    input_image: str | None = None,
-    lora_name: str | None = None,
-    width: int = 1024,
-    height: int = 1024,
-    denoise: float = 0.6,
-) -> dict:
-    """动态构建 Flux.1 Schnell ComfyUI workflow dict。
+# 生成工作流 SaveImage 的文件名前缀：原图 / 串接抠图后的透明图
+_FLUX_SAVE_PREFIX = "game_asset"
+_FLUX_ALPHA_SAVE_PREFIX = "game_asset_rmbg"
 
-    根据参数条件注入节点：
-    - lora_name → 注入 LoraLoader 节点
-    - controlnet.enabled=True → 注入 ControlNet Union 节点
-    - input_image → img2img 模式（LoadImage + VAEEncode）
+
+@functools.lru_cache(maxsize=64)
+def _compile_flux_template(
+    *,
+    lora_name: str | None,
+    controlnet_type: str | None,
+    img2img: bool,
+    batched: bool,
+    controlnet_preprocessed: bool = False,
+    remove_background: bool = False,
+    branches: int = 1,
+) -> _WorkflowTemplate:
+    """按工作流形状编译 Flux.1 Schnell 节点图，结果按形状缓存。
+
+    形状 = (LoRA, ControlNet 类型, 控制图是否已预处理, img2img/txt2img, 是否 latent batch,
+    是否串接抠图, 采样分支数)；
+    seed / prompt / 图片等逐帧变化的参数以占位值写入，记录在 slots 中。
     """
     workflow: dict[str, dict] = {}
+    slots: dict[str, list[tuple[str, str]]] = {}
     nid = _NodeIdCounter()
 
+    def slot(name: str, node_id: str, key: str) -> None:
+        slots.setdefault(name, []).append((node_id, key))
+
     # ===================== 1. 模型加载（GGUF） =====================
 
     unet_id = nid.next()
@@ -139,12 +222,11 @@ def build_flux_workflow(
     # ===================== 4. LoRA（可选） =====================
 
     if lora_name:
-        lora_name_clean = Path(lora_name).name
         lora_id = nid.next()
         workflow[lora_id] = {
             "class_type": "LoraLoader",
             "inputs": {
-                "lora_name": lora_name_clean,
+                "lora_name": lora_name,
                 "strength_model": 1.0,
                 "strength_clip": 1.0,
                 "model": model_out,
@@ -161,12 +243,14 @@ def build_flux_workflow(
     workflow[pos_clip_id] = {
         "class_type": "CLIPTextEncodeFlux",
         "inputs": {
-            "clip_l": prompt,
-            "t5xxl": prompt,
+            "clip_l": "",
+            "t5xxl": "",
             "guidance": 3.5,
             "clip": clip_out,
         },
     }
+    slot("prompt", pos_clip_id, "clip_l")
+    slot("prompt", pos_clip_id, "t5xxl")
     positive_cond = [pos_clip_id, 0]
 
     # Flux Schnell 不使用 negative prompt，但需要空 conditioning
@@ -184,36 +268,25 @@ def build_flux_workflow(
 
     # ===================== 6. ControlNet（可选） =====================
 
-    if controlnet and controlnet.get("enabled"):
-        cn_type = controlnet.get("type", "canny")
-        cn_image = controlnet.get("image", "")
-        cn_strength = controlnet.get("strength", 1.0)
-
-        # 从 URL 路径提取文件名
-        if cn_image and "/" in cn_image:
-            cn_image = cn_image.split("/")[-1]
-
+    if controlnet_type:
         # 加载控制图
         ctrl_img_id = nid.next()
         workflow[ctrl_img_id] = {
             "class_type": "LoadImage",
-            "inputs": {"image": cn_image},
-        }
-
-        # 预处理器
-        preprocessor = CONTROLNET_PREPROCESSOR_MAP.get(cn_type, "CannyEdgePreprocessor")
-        preproc_id = nid.next()
-        preproc_inputs: dict[str, Any] = {
-            "image": [ctrl_img_id, 0],
-            "resolution": 1024,
-        }
-        if cn_type == "canny":
-            preproc_inputs["low_threshold"] = 100
-            preproc_inputs["high_threshold"] = 200
-        workflow[preproc_id] = {
-            "class_type": preprocessor,
-            "inputs": preproc_inputs,
+            "inputs": {"image": ""},
         }
+        slot("controlnet_image", ctrl_img_id, "image")
+        control_map = [ctrl_img_id, 0]
+
+        # 预处理器（控制图已是缓存的预处理结果时跳过）
+        if not controlnet_preprocessed:
+            preprocessor = CONTROLNET_PREPROCESSOR_MAP.get(controlnet_type, "CannyEdgePreprocessor")
+            preproc_id = nid.next()
+            workflow[preproc_id] = {
+                "class_type": preprocessor,
+                "inputs": {"image": control_map, **controlnet_preprocess_params(controlnet_type)},
+            }
+            control_map = [preproc_id, 0]
 
         # 加载 ControlNet Union 模型
         cn_loader_id = nid.next()
@@ -224,7 +297,7 @@ def build_flux_workflow(
         cn_model_ref = [cn_loader_id, 0]
 
         # 设置 Union 控制类型
-        union_type_idx = CONTROLNET_UNION_TYPE_MAP.get(cn_type, 0)
+        union_type_idx = CONTROLNET_UNION_TYPE_MAP.get(controlnet_type, 0)
         cn_type_id = nid.next()
         workflow[cn_type_id] = {
             "class_type": "SetUnionControlNetType",
@@ -243,108 +316,255 @@ def build_flux_workflow(
                 "positive": positive_cond,
                 "negative": negative_cond,
                 "control_net": cn_model_ref,
-                "image": [preproc_id, 0],
-                "strength": cn_strength,
+                "image": control_map,
+                "strength": 1.0,
                 "start_percent": 0.0,
                 "end_percent": 1.0,
             },
         }
+        slot("controlnet_strength", cn_apply_id, "strength")
         positive_cond = [cn_apply_id, 0]
         negative_cond = [cn_apply_id, 1]
 
     # ===================== 7. Latent 输入 =====================
 
-    if input_image:
+    if img2img:
         # img2img: LoadImage → VAEEncode
         img_load_id = nid.next()
         workflow[img_load_id] = {
             "class_type": "LoadImage",
-            "inputs": {"image": input_image},
+            "inputs": {"image": ""},
         }
+        slot("input_image", img_load_id, "image")
         vae_encode_id = nid.next()
         workflow[vae_encode_id] = {
             "class_type": "VAEEncode",
             "inputs": {"pixels": [img_load_id, 0], "vae": vae_out},
         }
         latent_out = [vae_encode_id, 0]
-        denoise_val = denoise
+        if batched:
+            repeat_id = nid.next()
+            workflow[repeat_id] = {
+                "class_type": "RepeatLatentBatch",
+                "inputs": {"samples": latent_out, "amount": 1},
+            }
+            slot("batch_size", repeat_id, "amount")
+            latent_out = [repeat_id, 0]
+        denoise_slot = True
     else:
         # txt2img: EmptySD3LatentImage (Flux 使用 SD3 latent 格式)
         empty_latent_id = nid.next()
         workflow[empty_latent_id] = {
             "class_type": "EmptySD3LatentImage",
-            "inputs": {"width": width, "height": height, "batch_size": 1},
+            "inputs": {"width": 1024, "height": 1024, "batch_size": 1},
         }
+        slot("width", empty_latent_id, "width")
+        slot("height", empty_latent_id, "height")
+        slot("batch_size", empty_latent_id, "batch_size")
         latent_out = [empty_latent_id, 0]
-        denoise_val = 1.0
+        denoise_slot = False
 
     # ===================== 8. KSampler =====================
+    # 每个 seed 一条 KSampler → VAEDecode → SaveImage（→ 抠图）分支，共享模型、条件与 latent；
+    # branches=1 时节点图与单帧工作流完全一致
 
-    ksampler_id = nid.next()
-    workflow[ksampler_id] = {
-        "class_type": "KSampler",
-        "inputs": {
-            "seed": seed,
-            "steps": 4,
-            "cfg": 1.0,
-            "sampler_name": "euler",
-            "scheduler": "simple",
-            "denoise": denoise_val,
-            "model": model_out,
-            "positive": positive_cond,
-            "negative": negative_cond,
-            "latent_image": latent_out,
-        },
-    }
+    for branch in range(branches):
+        ksampler_id = nid.next()
+        workflow[ksampler_id] = {
+            "class_type": "KSampler",
+            "inputs": {
+                "seed": 0,
+                "steps": 4,
+                "cfg": 1.0,
+                "sampler_name": "euler",
+                "scheduler": "simple",
+                "denoise": 1.0,
+                "model": model_out,
+                "positive": positive_cond,
+                "negative": negative_cond,
+                "latent_image": latent_out,
+            },
+        }
+        slot("seed" if branches == 1 else f"seed_{branch}", ksampler_id, "seed")
+        if denoise_slot:
+            slot("denoise", ksampler_id, "denoise")
 
-    # ===================== 9. VAE Decode =====================
+        # ===================== 9. VAE Decode =====================
 
-    vae_decode_id = nid.next()
-    workflow[vae_decode_id] = {
-        "class_type": "VAEDecode",
-        "inputs": {"samples": [ksampler_id, 0], "vae": vae_out},
-    }
+        vae_decode_id = nid.next()
+        workflow[vae_decode_id] = {
+            "class_type": "VAEDecode",
+            "inputs": {"samples": [ksampler_id, 0], "vae": vae_out},
+        }
+
+        # ===================== 10. SaveImage =====================
+
+        save_id = nid.next()
+        workflow[save_id] = {
+            "class_type": "SaveImage",
+            "inputs": {"filename_prefix": _FLUX_SAVE_PREFIX, "images": [vae_decode_id, 0]},
+        }
+
+        # ===================== 11. 抠图（可选） =====================
+
+        if remove_background:
+            # VAEDecode 输出直接接 BiRefNet，原图与透明图在同一 prompt 内保存
+            rmbg_id = nid.next()
+            workflow[rmbg_id] = {
+                "class_type": "RMBG",
+                "inputs": {"image": [vae_decode_id, 0], "model": REMOVE_BG_MODELS[DEFAULT_REMOVE_BG_MODEL]},
+            }
+            alpha_save_id = nid.next()
+            workflow[alpha_save_id] = {
+                "class_type": "SaveImage",
+                "inputs": {"filename_prefix": _FLUX_ALPHA_SAVE_PREFIX, "images": [rmbg_id, 0]},
+            }
+
+    return _WorkflowTemplate(
+        graph=workflow,
+        slots={name: tuple(refs) for name, refs in slots.items()},
+    )
 
-    # ===================== 10. SaveImage =====================
 
-    save_id = nid.next()
-    workflow[save_id] = {
-        "class_type": "SaveImage",
-        "inputs": {"filename_prefix": "game_asset", "images": [vae_decode_id, 0]},
+def build_flux_workflow(
+    *,
+    prompt: str,
+    negative_prompt: str = "",
+    seed: int,
+    controlnet: dict | None = None,
+    input_image: str | None = None,
+    lora_name: str | None = None,
+    width: int = 1024,
+    height: int = 1024,
+    denoise: float = 0.6,
+    batch_size: int = 1,
+    remove_background: bool = False,
+    seeds: list[int] | None = None,
+) -> dict:
+    """动态构建 Flux.1 Schnell ComfyUI workflow dict。
+
+    根据参数条件注入节点：
+    - lora_name → 注入 LoraLoader 节点
+    - controlnet.enabled=True → 注入 ControlNet Union 节点
+      （controlnet.preprocessed=True 表示 image 已是预处理图，不再注入预处理器）
+    - input_image → img2img 模式（LoadImage + VAEEncode）
+    - batch_size > 1 → 一个 prompt 内以 latent batch 渲染多张变体（共用 seed，各张噪声由
+      batch index 决定）
+    - seeds 多于一个 → 一个 prompt 内每个 seed 一条采样分支（忽略 seed / batch_size），
+      第 k 张与单独用 seeds[k] 渲染的结果相同
+    - remove_background=True → VAEDecode 后串接 RMBG (BiRefNet)，另存透明图
+      （用 split_flux_outputs 区分原图与透明图）
+
+    节点图结构按形状缓存在 _compile_flux_template 中，这里只替换参数。
+    """
+    cn_enabled = bool(controlnet and controlnet.get("enabled"))
+    branches = len(seeds) if seeds and len(seeds) > 1 else 1
+    if branches > 1:
+        batch_size = 1
+    elif seeds:
+        seed = seeds[0]
+    template = _compile_flux_template(
+        lora_name=Path(lora_name).name if lora_name else None,
+        controlnet_type=controlnet.get("type", "canny") if cn_enabled else None,
+        img2img=bool(input_image),
+        batched=batch_size > 1,
+        controlnet_preprocessed=cn_enabled and bool(controlnet.get("preprocessed")),
+        remove_background=remove_background,
+        branches=branches,
+    )
+
+    values: dict[str, Any] = {
+        "prompt": prompt,
+        "batch_size": batch_size,
     }
+    if branches > 1:
+        values.update({f"seed_{i}": s for i, s in enumerate(seeds)})
+    else:
+        values["seed"] = seed
+    if input_image:
+        values["input_image"] = input_image
+        values["denoise"] = denoise
+    else:
+        values["width"] = width
+        values["height"] = height
 
-    return workflow
+    if cn_enabled:
+        cn_image = controlnet.get("image", "")
+        # 从 URL 路径提取文件名
+        if cn_image and "/" in cn_image:
+            cn_image = cn_image.split("/")[-1]
+        values["controlnet_image"] = cn_image
+        values["controlnet_strength"] = controlnet.get("strength", 1.0)
+
+    return template.render(**values)
 
 
 # ---------------------------------------------------------------------------
 #  BiRefNet 背景移除工作流
 # ---------------------------------------------------------------------------
 
-def build_remove_bg_workflow(*, image_name: str) -> dict:
+def build_remove_bg_workflow(*, image_name: str, model: str = DEFAULT_REMOVE_BG_MODEL) -> dict:
     """构建 BiRefNet 背景移除工作流。
 
-    LoadImage → RMBG (BiRefNet) → SaveImage (PNG with alpha)
+    LoadImage → RMBG (BiRefNet / BiRefNet-HR) → SaveImage (PNG with alpha)
     """
-    return {
-        "1": {
+    return build_remove_bg_batch_workflow(image_names=[image_name], model=model)
+
+
+def _remove_bg_node_ids(index: int) -> tuple[str, str, str]:
+    """第 index 张图片所在链路的 (LoadImage, RMBG, SaveImage) 节点 id。"""
+    base = 3 * index
+    return str(base + 1), str(base + 2), str(base + 3)
+
+
+def build_remove_bg_batch_workflow(
+    *,
+    image_names: list[str],
+    model: str = DEFAULT_REMOVE_BG_MODEL,
+) -> dict:
+    """在一个 prompt 内用同一个模型对多张图片做背景移除。
+
+    每张图片一条独立的 LoadImage → RMBG → SaveImage 链路（尺寸各异，不能拼成
+    一个 image batch）；同一 prompt 内 BiRefNet 只加载一次，也只需一次排队往返。
+    结果用 remove_bg_batch_outputs 按图片顺序取回。
+    """
+    rmbg_model = REMOVE_BG_MODELS.get(model, REMOVE_BG_MODELS[DEFAULT_REMOVE_BG_MODEL])
+    workflow: dict[str, dict] = {}
+    for i, image_name in enumerate(image_names):
+        load_id, rmbg_id, save_id = _remove_bg_node_ids(i)
+        workflow[load_id] = {
             "class_type": "LoadImage",
             "inputs": {"image": image_name},
-        },
-        "2": {
+        }
+        workflow[rmbg_id] = {
             "class_type": "RMBG",
             "inputs": {
-                "image": ["1", 0],
-                "model": "BiRefNet",
+                "image": [load_id, 0],
+                "model": rmbg_model,
             },
-        },
-        "3": {
+        }
+        workflow[save_id] = {
             "class_type": "SaveImage",
             "inputs": {
                 "filename_prefix": "rmbg",
-                "images": ["2", 0],
+                "images": [rmbg_id, 0],
             },
-        },
-    }
+        }
+    return workflow
+
+
+def remove_bg_batch_outputs(history: dict, count: int) -> list[dict | None]:
+    """按图片顺序取出批量抠图各链路的输出图片，缺失的位置为 None。"""
+    outputs = history.get("outputs", {})
+    results: list[dict | None] = []
+    for i in range(count):
+        _, _, save_id = _remove_bg_node_ids(i)
+        images = [
+            img for img in outputs.get(save_id, {}).get("images", [])
+            if img.get("filename")
+        ]
+        results.append(images[0] if images else None)
+    return results
 
 
 # ---------------------------------------------------------------------------
@@ -361,11 +581,8 @@ def build_controlnet_preview_workflow(
 
     preproc_inputs: dict[str, Any] = {
         "image": ["1", 0],
-        "resolution": 1024,
+        **controlnet_preprocess_params(control_type),
     }
-    if control_type == "canny":
-        preproc_inputs["low_threshold"] = 100
-        preproc_inputs["high_threshold"] = 200
 
     return {
         "1": {
@@ -390,95 +607,846 @@ def build_controlnet_preview_workflow(
 #  ComfyUI API 交互
 # ---------------------------------------------------------------------------
 
-async def queue_prompt(workflow: dict, client_id: str | None = None) -> str:
-    """Submit a workflow to ComfyUI and return the prompt_id."""
-    if client_id is None:
-        client_id = str(uuid.uuid4())
+# 连接池配置：总连接数 / 单主机连接数 / keep-alive 保活秒数 / 单次请求超时秒数
+COMFYUI_POOL_LIMIT = int(os.getenv("COMFYUI_POOL_LIMIT", "32"))
+COMFYUI_POOL_LIMIT_PER_HOST = int(os.getenv("COMFYUI_POOL_LIMIT_PER_HOST", "16"))
+COMFYUI_KEEPALIVE_TIMEOUT = float(os.getenv("COMFYUI_KEEPALIVE_TIMEOUT", "60"))
+COMFYUI_REQUEST_TIMEOUT = float(os.getenv("COMFYUI_REQUEST_TIMEOUT", "30"))
+
+# WebSocket 监听：断线重连退避上限 / 等待者兜底轮询 history 的间隔（秒）
+COMFYUI_WS_RECONNECT_MAX = float(os.getenv("COMFYUI_WS_RECONNECT_MAX", "10"))
+COMFYUI_WS_POLL_INTERVAL = float(os.getenv("COMFYUI_WS_POLL_INTERVAL", "10"))
+
+# 记录最近完成的 prompt，用于处理“等待者注册前 prompt 已完成”的竞态
+_FINISHED_PROMPTS_MAX = 1024
 
-    payload = {"prompt": workflow, "client_id": client_id}
+# /view 下载时每次读取的块大小
+_VIEW_CHUNK = 256 * 1024
+# history entry 中记录所在后端地址的键（非 ComfyUI 字段），用于从同一后端下载结果
+_HISTORY_BACKEND_KEY = "_backend_url"
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(f"{COMFYUI_URL}/prompt", json=payload) as resp:
+
+class _PromptWatch:
+    """单个 prompt 的等待句柄：进度事件队列，None 表示执行结束。"""
+
+    def __init__(self) -> None:
+        self.events: asyncio.Queue[float | None] = asyncio.Queue()
+
+
+class ComfyUIClient:
+    """长生命周期的 ComfyUI 客户端。
+
+    整个进程共享一个带连接池（keep-alive）的 aiohttp session 和一条
+    WebSocket 监听连接；所有 prompt 以同一个 client_id 提交，监听器按
+    prompt_id 把 progress / executing 事件分发给各自的等待者。
+    由 FastAPI lifespan 负责 start/close；未启动时首次调用会惰性创建。
+    """
+
+    def __init__(
+        self,
+        base_url: str = COMFYUI_URL,
+        *,
+        limit: int = COMFYUI_POOL_LIMIT,
+        limit_per_host: int = COMFYUI_POOL_LIMIT_PER_HOST,
+        keepalive_timeout: float = COMFYUI_KEEPALIVE_TIMEOUT,
+        request_timeout: float = COMFYUI_REQUEST_TIMEOUT,
+    ) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.client_id = str(uuid.uuid4())
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._keepalive_timeout = keepalive_timeout
+        self._request_timeout = aiohttp.ClientTimeout(total=request_timeout)
+        self._session: aiohttp.ClientSession | None = None
+        self._listener: asyncio.Task | None = None
+        self._connected = asyncio.Event()
+        self._watches: dict[str, _PromptWatch] = {}
+        self._finished: OrderedDict[str, None] = OrderedDict()
+
+    @property
+    def ws_base_url(self) -> str:
+        return self.base_url.replace("http", "ws", 1)
+
+    async def start(self) -> None:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self._limit,
+                limit_per_host=self._limit_per_host,
+                keepalive_timeout=self._keepalive_timeout,
+            )
+            # session 级别不设总超时（WebSocket 需要长连接），HTTP 请求单独传超时
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=None),
+            )
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+
+    async def close(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._listener = None
+        self._connected.clear()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed or self._listener is None:
+            await self.start()
+        assert self._session is not None
+        return self._session
+
+    # ---------------- WebSocket 监听 ----------------
+
+    async def _listen(self) -> None:
+        """常驻监听 ComfyUI WebSocket，断线后指数退避重连。"""
+        ws_url = f"{self.ws_base_url}/ws?clientId={self.client_id}"
+        backoff = 0.5
+        while True:
+            try:
+                assert self._session is not None
+                async with self._session.ws_connect(ws_url, heartbeat=30) as ws:
+                    self._connected.set()
+                    backoff = 0.5
+                    logger.info("ComfyUI WebSocket 已连接: %s", self.base_url)
+                    # 断线期间可能错过完成事件，重连后补查一次
+                    await self._resync()
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            self._dispatch(json.loads(msg.data))
+                        elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("ComfyUI WebSocket 连接失败: %s", exc)
+            self._connected.clear()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, COMFYUI_WS_RECONNECT_MAX)
+
+    def _dispatch(self, data: dict) -> None:
+        msg_type = data.get("type")
+        d = data.get("data") or {}
+        prompt_id = d.get("prompt_id")
+        if not prompt_id:
+            return
+
+        if msg_type == "progress":
+            watch = self._watches.get(prompt_id)
+            if watch and d.get("max"):
+                watch.events.put_nowait(d["value"] / d["max"] * 100)
+
+        elif msg_type == "executing" and d.get("node") is None:
+            self._mark_finished(prompt_id)
+
+        elif msg_type in ("execution_error", "execution_interrupted"):
+            self._mark_finished(prompt_id)
+
+    def _mark_finished(self, prompt_id: str) -> None:
+        self._finished[prompt_id] = None
+        self._finished.move_to_end(prompt_id)
+        while len(self._finished) > _FINISHED_PROMPTS_MAX:
+            self._finished.popitem(last=False)
+        watch = self._watches.get(prompt_id)
+        if watch:
+            watch.events.put_nowait(None)
+
+    async def _resync(self) -> None:
+        for prompt_id in list(self._watches):
+            try:
+                if await self.get_history(prompt_id):
+                    self._mark_finished(prompt_id)
+            except Exception:
+                pass
+
+    async def wait_for_completion(
+        self,
+        prompt_id: str,
+        *,
+        on_progress: Any = None,
+        timeout: float = 300,
+    ) -> dict:
+        """等待 prompt 执行完成，返回 history entry。"""
+        await self.session()
+        watch = _PromptWatch()
+        self._watches[prompt_id] = watch
+        if prompt_id in self._finished:
+            watch.events.put_nowait(None)
+
+        try:
+            async with asyncio.timeout(timeout):
+                while True:
+                    try:
+                        pct = await asyncio.wait_for(
+                            watch.events.get(), timeout=COMFYUI_WS_POLL_INTERVAL
+                        )
+                    except TimeoutError:
+                        # 监听器断线等情况下的兜底：history 出现即视为完成
+                        history = await self.get_history(prompt_id)
+                        if history:
+                            return history
+                        continue
+                    if pct is None:
+                        break
+                    if on_progress:
+                        await on_progress(pct)
+        except TimeoutError:
+            logger.warning("Timeout waiting for prompt %s", prompt_id)
+        finally:
+            self._watches.pop(prompt_id, None)
+
+        return await self.get_history(prompt_id)
+
+    # ---------------- REST ----------------
+
+    async def queue_prompt(self, workflow: dict) -> str:
+        """Submit a workflow to ComfyUI and return the prompt_id."""
+        payload = {"prompt": workflow, "client_id": self.client_id}
+
+        session = await self.session()
+        # 尽量在监听器连上后再提交，避免错过早期事件（超时则依赖兜底轮询）
+        if not self._connected.is_set():
+            try:
+                await asyncio.wait_for(self._connected.wait(), timeout=5)
+            except TimeoutError:
+                pass
+
+        async with session.post(
+            f"{self.base_url}/prompt", json=payload, timeout=self._request_timeout
+        ) as resp:
             resp.raise_for_status()
             data = await resp.json()
             prompt_id = data["prompt_id"]
             logger.info("Queued prompt %s", prompt_id)
             return prompt_id
 
+    async def get_history(self, prompt_id: str) -> dict:
+        """Fetch the history entry for a prompt."""
+        session = await self.session()
+        async with session.get(
+            f"{self.base_url}/history/{prompt_id}", timeout=self._request_timeout
+        ) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+            entry = data.get(prompt_id, {})
+            if entry:
+                entry[_HISTORY_BACKEND_KEY] = self.base_url
+            return entry
+
+    async def check_health(self) -> bool:
+        """Check if ComfyUI is reachable."""
+        try:
+            session = await self.session()
+            async with session.get(
+                f"{self.base_url}/system_stats",
+                timeout=aiohttp.ClientTimeout(total=5),
+            ) as resp:
+                return resp.status == 200
+        except Exception:
+            return False
+
+    async def free_memory(self, *, unload_models: bool = False, free_memory: bool = True) -> bool:
+        """调用 /free 释放显存缓存，成功返回 True。"""
+        session = await self.session()
+        async with session.post(
+            f"{self.base_url}/free",
+            json={"unload_models": unload_models, "free_memory": free_memory},
+            timeout=aiohttp.ClientTimeout(total=10),
+        ) as resp:
+            return resp.status == 200
+
+    async def system_stats(self) -> dict:
+        """获取 /system_stats（含各设备 vram_total / vram_free）。"""
+        session = await self.session()
+        async with session.get(
+            f"{self.base_url}/system_stats", timeout=self._request_timeout
+        ) as resp:
+            resp.raise_for_status()
+            return await resp.json()
+
+    async def download_image(self, image: dict, dest: Path) -> int:
+        """经 /view 按块流式下载一张输出图片到 dest，返回字节数。
+
+        先写入同目录临时文件再原子替换，写盘在 fileio 线程池中执行。
+        """
+        session = await self.session()
+        params = {
+            "filename": image["filename"],
+            "subfolder": image.get("subfolder", ""),
+            "type": image.get("type", "output"),
+        }
+        # 大文件下载不设总超时，只限制两次读取之间的间隔
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=self._request_timeout.total)
+        tmp = dest.with_name(f".{dest.name}.{uuid.uuid4().hex[:8]}.tmp")
+        size = 0
+        async with session.get(f"{self.base_url}/view", params=params, timeout=timeout) as resp:
+            resp.raise_for_status()
+            f = await fileio.run(open, tmp, "wb")
+            try:
+                async for chunk in resp.content.iter_chunked(_VIEW_CHUNK):
+                    await fileio.run(f.write, chunk)
+                    size += len(chunk)
+                await fileio.run(f.close)
+            except BaseException:
+                await fileio.run(f.close)
+                await fileio.run(tmp.unlink, True)
+                raise
+        await fileio.run(os.replace, tmp, dest)
+        return size
+
+    async def upload_image(self, path: Path, name: str) -> None:
+        """经 /upload/image 把本地图片以 name 上传到 ComfyUI input 目录。"""
+        session = await self.session()
+        f = await fileio.run(open, path, "rb")
+        try:
+            form = aiohttp.FormData()
+            form.add_field("image", f, filename=name, content_type="application/octet-stream")
+            form.add_field("type", "input")
+            form.add_field("overwrite", "true")
+            timeout = aiohttp.ClientTimeout(total=None, sock_read=self._request_timeout.total)
+            async with session.post(
+                f"{self.base_url}/upload/image", data=form, timeout=timeout
+            ) as resp:
+                resp.raise_for_status()
+        finally:
+            await fileio.run(f.close)
+
+    async def queue_depth(self) -> int:
+        """获取 /queue 中正在执行与排队的 prompt 总数。"""
+        session = await self.session()
+        async with session.get(
+            f"{self.base_url}/queue", timeout=aiohttp.ClientTimeout(total=5)
+        ) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+            return len(data.get("queue_running", [])) + len(data.get("queue_pending", []))
+
+
+# ---------------------------------------------------------------------------
+#  输入图片上传 — 按后端缓存已上传的内容哈希
+# ---------------------------------------------------------------------------
+
+# 每个后端记录的已上传输入总大小上限（MB），超出后按最久未用淘汰记录
+COMFYUI_UPLOAD_CACHE_MB = int(os.getenv("COMFYUI_UPLOAD_CACHE_MB", "1024"))
+
+
+class InputTransfer:
+    """经 /upload/image 把输入图片交给各 ComfyUI 实例。
+
+    输入图以内容哈希命名（file_store.input_name），本地暂存在 input_dir 中，
+    LoadImage 引用的文件名即可定位本地文件；同一后端上已上传过的文件不会再次发送。
+    每个后端的记录按总大小 cache_bytes 做 LRU 淘汰（被淘汰的文件下次引用时以同一
+    内容哈希名重新上传，以应对远端清理 input 目录）。同一文件并发引用时只上传一次。
+    """
+
+    def __init__(
+        self,
+        *,
+        input_dir: Path = COMFYUI_INPUT_DIR,
+        cache_bytes: int = COMFYUI_UPLOAD_CACHE_MB * 1024 * 1024,
+    ) -> None:
+        self._input_dir = input_dir
+        self._cache_bytes = cache_bytes
+        self._uploaded: dict[str, OrderedDict[str, int]] = {}
+        self._cached_bytes: dict[str, int] = {}
+        self._pending: dict[tuple[str, str], asyncio.Future[None]] = {}
+        self._stats = {"uploads": 0, "hits": 0, "bytes_uploaded": 0, "evictions": 0}
+
+    async def ensure(self, client: ComfyUIClient, workflow: dict) -> None:
+        """确保 workflow 中 LoadImage 引用的（按内容哈希命名的）输入都已上传到 client 对应的实例。"""
+        names = {
+            node["inputs"].get("image")
+            for node in workflow.values()
+            if node.get("class_type") == "LoadImage"
+        }
+        await asyncio.gather(*(
+            self._ensure_one(client, name) for name in names if name and is_content_name(name)
+        ))
+
+    async def _ensure_one(self, client: ComfyUIClient, name: str) -> None:
+        url = client.base_url
+        cache = self._uploaded.setdefault(url, OrderedDict())
+        if name in cache:
+            cache.move_to_end(name)
+            self._stats["hits"] += 1
+            return
+
+        key = (url, name)
+        pending = self._pending.get(key)
+        if pending is not None:
+            await asyncio.shield(pending)
+            return
+
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            path = self._input_dir / name
+            size = (await fileio.run(path.stat)).st_size
+            await client.upload_image(path, name)
+        except BaseException as exc:
+            future.set_exception(exc)
+            # 没有其他等待者时避免 “exception was never retrieved” 警告
+            future.exception()
+            raise
+        else:
+            future.set_result(None)
+        finally:
+            self._pending.pop(key, None)
+
+        self._stats["uploads"] += 1
+        self._stats["bytes_uploaded"] += size
+        cache[name] = size
+        self._cached_bytes[url] = self._cached_bytes.get(url, 0) + size
+        while self._cached_bytes[url] > self._cache_bytes and len(cache) > 1:
+            _, evicted = cache.popitem(last=False)
+            self._cached_bytes[url] -= evicted
+            self._stats["evictions"] += 1
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            **self._stats,
+            "cached": {url: len(cache) for url, cache in self._uploaded.items()},
+            "cached_bytes": dict(self._cached_bytes),
+        }
+
+
+# ---------------------------------------------------------------------------
+#  多后端池 — 负载 / 模型亲和路由 + 故障转移
+# ---------------------------------------------------------------------------
+
+# 逗号分隔的 ComfyUI 地址列表，未设置时只使用 COMFYUI_URL
+COMFYUI_URLS = [
+    url.strip() for url in os.getenv("COMFYUI_URLS", COMFYUI_URL).split(",") if url.strip()
+]
+# 健康检查（/system_stats）与队列深度（/queue）轮询间隔（秒）
+COMFYUI_HEALTH_INTERVAL = float(os.getenv("COMFYUI_HEALTH_INTERVAL", "5"))
+# 连续失败多少次判定后端不可用
+COMFYUI_HEALTH_FAILURES = int(os.getenv("COMFYUI_HEALTH_FAILURES", "2"))
+# 模型亲和的权重：已加载所需 LoRA / ControlNet 的后端可多承担的排队 prompt 数
+COMFYUI_AFFINITY_WEIGHT = float(os.getenv("COMFYUI_AFFINITY_WEIGHT", "2"))
+# 每个后端记录的最近使用模型数（近似 ComfyUI 中仍驻留的模型）
+COMFYUI_AFFINITY_MODELS = int(os.getenv("COMFYUI_AFFINITY_MODELS", "8"))
+
+# 参与亲和路由的 (节点类型, 输入名)：切换代价高、各任务不同的模型
+_AFFINITY_INPUTS: dict[str, str] = {
+    "LoraLoader": "lora_name",
+    "ControlNetLoader": "control_net_name",
+    "RMBG": "model",
+}
+
+_ROUTES_MAX = 4096
+
+# 视为后端故障（需要换节点）的异常
+_BACKEND_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+
+class ComfyUIUnavailable(RuntimeError):
+    """没有可用的 ComfyUI 后端。"""
+
+
+def workflow_models(workflow: dict) -> frozenset[str]:
+    """提取工作流中参与亲和路由的模型名。"""
+    models: set[str] = set()
+    for node in workflow.values():
+        key = _AFFINITY_INPUTS.get(node.get("class_type", ""))
+        if key:
+            value = node.get("inputs", {}).get(key)
+            if isinstance(value, str) and value:
+                models.add(value)
+    return frozenset(models)
+
+
+class _Backend:
+    """池中的一个 ComfyUI 实例及其健康 / 负载状态。"""
+
+    def __init__(self, client: ComfyUIClient) -> None:
+        self.client = client
+        self.healthy = True
+        self.failures = 0
+        # 后端被判定不可用时置位，等待中的 prompt 据此转移
+        self.down = asyncio.Event()
+        self.queue_depth = 0
+        self.inflight = 0
+        self.submitted = 0
+        self.last_selected = 0
+        self.models: OrderedDict[str, None] = OrderedDict()
+
+    @property
+    def load(self) -> int:
+        # /queue 轮询有延迟，本进程刚提交的 prompt 以 inflight 补足
+        return max(self.queue_depth, self.inflight)
+
+    def affinity(self, models: frozenset[str]) -> float:
+        if not models:
+            return 0.0
+        return sum(1 for m in models if m in self.models) / len(models)
+
+    def remember(self, models: frozenset[str]) -> None:
+        for m in models:
+            self.models[m] = None
+            self.models.move_to_end(m)
+        while len(self.models) > COMFYUI_AFFINITY_MODELS:
+            self.models.popitem(last=False)
+
+    def mark_up(self) -> None:
+        self.failures = 0
+        if not self.healthy:
+            logger.info("ComfyUI 后端恢复: %s", self.client.base_url)
+            self.healthy = True
+            self.down = asyncio.Event()
+
+    def mark_down(self, reason: Any) -> None:
+        self.failures += 1
+        if self.healthy and self.failures >= COMFYUI_HEALTH_FAILURES:
+            logger.warning("ComfyUI 后端不可用: %s (%s)", self.client.base_url, reason)
+            self.healthy = False
+            self.down.set()
+
+
+@dataclass
+class _Route:
+    """已提交 prompt 所在的后端；故障转移后指向新的后端与 prompt_id。"""
+    workflow: dict
+    backend: _Backend
+    prompt_id: str
+
+
+class ComfyUIPool:
+    """多个 ComfyUI 后端组成的池，对外接口与 ComfyUIClient 相同。
+
+    - 后台协程定期查询各后端 /system_stats（健康）与 /queue（队列深度）
+    - 提交时在健康后端中选负载最低者；最近运行过同一 LoRA / ControlNet 的后端
+      享有 COMFYUI_AFFINITY_WEIGHT 的负载折扣，避免模型在节点间来回加载
+    - 提交失败或等待期间后端被判定不可用时，把工作流重新提交到其他后端
+    """
+
+    def __init__(self, urls: list[str] = COMFYUI_URLS, **client_kwargs: Any) -> None:
+        if not urls:
+            raise ValueError("至少需要一个 ComfyUI 地址")
+        self._backends = [_Backend(ComfyUIClient(url, **client_kwargs)) for url in urls]
+        self.inputs = InputTransfer()
+        self._routes: OrderedDict[str, _Route] = OrderedDict()
+        self._monitor: asyncio.Task | None = None
+        self._selections = 0
+        self._stats = {"submitted": 0, "failovers": 0, "affinity_hits": 0}
+
+    @property
+    def base_url(self) -> str:
+        return self._backends[0].client.base_url
+
+    async def start(self) -> None:
+        for backend in self._backends:
+            await backend.client.start()
+        if self._monitor is None or self._monitor.done():
+            self._monitor = asyncio.create_task(self._monitor_loop(), name="comfyui-monitor")
+
+    async def close(self) -> None:
+        if self._monitor is not None:
+            self._monitor.cancel()
+            await asyncio.gather(self._monitor, return_exceptions=True)
+            self._monitor = None
+        for backend in self._backends:
+            await backend.client.close()
+
+    # ---------------- 健康检查 ----------------
+
+    async def _monitor_loop(self) -> None:
+        while True:
+            await asyncio.gather(*(self._probe(b) for b in self._backends))
+            await asyncio.sleep(COMFYUI_HEALTH_INTERVAL)
+
+    async def _probe(self, backend: _Backend) -> None:
+        try:
+            await backend.client.system_stats()
+            backend.queue_depth = await backend.client.queue_depth()
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            backend.mark_down(exc)
+            return
+        backend.mark_up()
+
+    # ---------------- 路由 ----------------
+
+    def _select(self, models: frozenset[str], exclude: set[_Backend]) -> _Backend:
+        candidates = [b for b in self._backends if b.healthy and b not in exclude]
+        if not candidates:
+            # 全部被判定不可用时仍尝试未排除的后端（健康状态可能已过时）
+            candidates = [b for b in self._backends if b not in exclude]
+        if not candidates:
+            raise ComfyUIUnavailable("没有可用的 ComfyUI 后端")
+
+        def score(b: _Backend) -> tuple[float, int]:
+            return (b.load - COMFYUI_AFFINITY_WEIGHT * b.affinity(models), b.last_selected)
+
+        backend = min(candidates, key=score)
+        self._selections += 1
+        backend.last_selected = self._selections
+        if backend.affinity(models):
+            self._stats["affinity_hits"] += 1
+        return backend
+
+    async def _submit(self, workflow: dict, exclude: set[_Backend]) -> tuple[_Backend, str]:
+        """选择后端并提交，连接失败时换下一个后端。"""
+        models = workflow_models(workflow)
+        tried = set(exclude)
+        while True:
+            backend = self._select(models, tried)
+            try:
+                if COMFYUI_INPUT_MODE == "upload":
+                    await self.inputs.ensure(backend.client, workflow)
+                prompt_id = await backend.client.queue_prompt(workflow)
+            except _BACKEND_ERRORS as exc:
+                backend.mark_down(exc)
+                tried.add(backend)
+                continue
+            backend.inflight += 1
+            backend.submitted += 1
+            backend.remember(models)
+            self._stats["submitted"] += 1
+            return backend, prompt_id
+
+    def _route(self, prompt_id: str) -> _Route | None:
+        return self._routes.get(prompt_id)
+
+    async def queue_prompt(self, workflow: dict) -> str:
+        """提交到选中的后端，返回 prompt_id（等待时据此找到所在后端）。"""
+        backend, prompt_id = await self._submit(workflow, set())
+        self._routes[prompt_id] = _Route(workflow, backend, prompt_id)
+        while len(self._routes) > _ROUTES_MAX:
+            _, stale = self._routes.popitem(last=False)
+            stale.backend.inflight -= 1
+        return prompt_id
+
+    async def wait_for_completion(
+        self,
+        prompt_id: str,
+        *,
+        on_progress: Any = None,
+        timeout: float = 300,
+    ) -> dict:
+        """等待 prompt 完成；所在后端不可用时把工作流转移到其他后端继续等待。"""
+        route = self._route(prompt_id)
+        if route is None:
+            return await self._backends[0].client.wait_for_completion(
+                prompt_id, on_progress=on_progress, timeout=timeout
+            )
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            while True:
+                backend = route.backend
+                remaining = max(deadline - loop.time(), 0.0)
+                waiter = asyncio.create_task(backend.client.wait_for_completion(
+                    route.prompt_id, on_progress=on_progress, timeout=remaining
+                ))
+                down = asyncio.create_task(backend.down.wait())
+                try:
+                    await asyncio.wait({waiter, down}, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    down.cancel()
+                    if not waiter.done():
+                        waiter.cancel()
+
+                failure: BaseException | str | None = None
+                if waiter.done() and not waiter.cancelled():
+                    failure = waiter.exception()
+                    if failure is None:
+                        return waiter.result()
+                    if not isinstance(failure, _BACKEND_ERRORS):
+                        raise failure
+                    backend.mark_down(failure)
+                else:
+                    failure = "后端不可用"
+
+                # 重新提交成功后才把计数从原后端移走；提交失败（任何异常）时 route 仍指向原后端，
+                # 由 finally 统一扣减一次
+                try:
+                    new_backend, new_prompt_id = await self._submit(route.workflow, {backend})
+                except ComfyUIUnavailable:
+                    # 没有其他后端：回到原后端继续等待
+                    if isinstance(failure, BaseException):
+                        raise failure
+                    return await backend.client.wait_for_completion(
+                        route.prompt_id,
+                        on_progress=on_progress,
+                        timeout=max(deadline - loop.time(), 0.0),
+                    )
+                backend.inflight -= 1
+                route.backend, route.prompt_id = new_backend, new_prompt_id
+                self._stats["failovers"] += 1
+                logger.warning(
+                    "prompt %s 从 %s 转移到 %s (%s)",
+                    prompt_id, backend.client.base_url, route.backend.client.base_url, failure,
+                )
+        finally:
+            if self._routes.pop(prompt_id, None) is not None:
+                route.backend.inflight -= 1
+
+    # ---------------- 其他接口 ----------------
+
+    async def get_history(self, prompt_id: str) -> dict:
+        route = self._route(prompt_id)
+        if route is not None:
+            return await route.backend.client.get_history(route.prompt_id)
+        return await self._backends[0].client.get_history(prompt_id)
+
+    async def download_image(self, history: dict, image: dict, dest: Path) -> int:
+        """从产出 history 的后端下载一张输出图片。"""
+        url = history.get(_HISTORY_BACKEND_KEY)
+        backend = next((b for b in self._backends if b.client.base_url == url), self._backends[0])
+        return await backend.client.download_image(image, dest)
+
+    async def check_health(self) -> bool:
+        """任一后端可达即视为可用。"""
+        results = await asyncio.gather(*(b.client.check_health() for b in self._backends))
+        return any(results)
+
+    async def system_stats(self) -> dict:
+        """合并各健康后端的 /system_stats 设备列表（显存策略按最高占用率判断）。"""
+        devices: list[dict] = []
+        for backend in self._backends:
+            if not backend.healthy:
+                continue
+            try:
+                stats = await backend.client.system_stats()
+            except Exception:
+                continue
+            devices.extend(stats.get("devices", []))
+        return {"devices": devices}
+
+    async def free_memory(self, *, unload_models: bool = False, free_memory: bool = True) -> bool:
+        """在各健康后端上调用 /free，任一成功返回 True。"""
+        results = await asyncio.gather(
+            *(
+                b.client.free_memory(unload_models=unload_models, free_memory=free_memory)
+                for b in self._backends
+                if b.healthy
+            ),
+            return_exceptions=True,
+        )
+        return any(r is True for r in results)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            **self._stats,
+            "inputs": self.inputs.stats(),
+            "backends": [
+                {
+                    "url": b.client.base_url,
+                    "healthy": b.healthy,
+                    "queue_depth": b.queue_depth,
+                    "inflight": b.inflight,
+                    "submitted": b.submitted,
+                    "models": list(b.models),
+                }
+                for b in self._backends
+            ],
+        }
+
+
+# 进程级共享后端池
+comfy_client = ComfyUIPool()
+
+
+async def queue_prompt(workflow: dict) -> str:
+    """Submit a workflow to ComfyUI and return the prompt_id."""
+    return await comfy_client.queue_prompt(workflow)
+
 
 async def wait_for_completion(
     prompt_id: str,
     *,
-    client_id: str | None = None,
     on_progress: Any = None,
     timeout: float = 300,
 ) -> dict:
-    """Wait for a prompt to finish via WebSocket, returns history entry."""
-    if client_id is None:
-        client_id = str(uuid.uuid4())
+    """Wait for a prompt to finish via the shared WebSocket listener, returns history entry."""
+    return await comfy_client.wait_for_completion(
+        prompt_id, on_progress=on_progress, timeout=timeout
+    )
 
-    ws_url = f"{COMFYUI_URL.replace('http', 'ws')}/ws?clientId={client_id}"
 
-    try:
-        async with asyncio.timeout(timeout):
-            async with aiohttp.ClientSession() as session:
-                async with session.ws_connect(ws_url) as ws:
-                    async for msg in ws:
-                        if msg.type == aiohttp.WSMsgType.TEXT:
-                            data = json.loads(msg.data)
-                            msg_type = data.get("type")
+async def get_history(prompt_id: str) -> dict:
+    """Fetch the history entry for a prompt."""
+    return await comfy_client.get_history(prompt_id)
 
-                            if msg_type == "progress":
-                                d = data["data"]
-                                if d.get("prompt_id") == prompt_id and on_progress:
-                                    pct = d["value"] / d["max"] * 100
-                                    await on_progress(pct)
 
-                            elif msg_type == "executing":
-                                d = data["data"]
-                                if d.get("prompt_id") == prompt_id and d.get("node") is None:
-                                    break
+async def stage_input_image(src: Path) -> str:
+    """准备一张输入图片，返回 LoadImage 节点使用的文件名。
 
-                        elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
-                            break
-    except TimeoutError:
-        logger.warning("Timeout waiting for prompt %s", prompt_id)
+    两种模式都以内容哈希名硬链接到本机 ComfyUI/input；upload 模式下该目录只是暂存区，
+    提交 prompt 时再由 InputTransfer 按文件名上传到选中的实例。
+    """
+    return await fileio.run(stage_input, src)
 
-    return await get_history(prompt_id)
 
+def output_images(history: dict) -> list[dict]:
+    """Extract output image refs ({filename, subfolder, type}) from a history entry."""
+    images: list[dict] = []
+    outputs = history.get("outputs", {})
+    for _node_id, node_output in outputs.items():
+        for img in node_output.get("images", []):
+            if img.get("filename"):
+                images.append(img)
+    return images
 
-async def get_history(prompt_id: str) -> dict:
-    """Fetch the history entry for a prompt."""
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"{COMFYUI_URL}/history/{prompt_id}") as resp:
-            resp.raise_for_status()
-            data = await resp.json()
-            return data.get(prompt_id, {})
+
+def split_flux_outputs(workflow: dict, history: dict) -> tuple[list[dict], list[dict]]:
+    """按 SaveImage 节点拆分生成工作流的输出：(原图, 串接抠图的透明图)。"""
+    outputs = history.get("outputs", {})
+    raw: list[dict] = []
+    alpha: list[dict] = []
+    for node_id, node in workflow.items():
+        if node.get("class_type") != "SaveImage":
+            continue
+        images = [img for img in outputs.get(node_id, {}).get("images", []) if img.get("filename")]
+        if node["inputs"].get("filename_prefix") == _FLUX_ALPHA_SAVE_PREFIX:
+            alpha.extend(images)
+        else:
+            raw.extend(images)
+    return raw, alpha
+
+
+def _local_output_path(image: dict) -> str:
+    return os.path.join(COMFYUI_OUTPUT_DIR, image.get("subfolder", ""), image["filename"])
 
 
 def extract_image_paths(history: dict) -> list[str]:
-    """Extract output image file paths from a history entry."""
-    paths: list[str] = []
-    outputs = history.get("outputs", {})
-    for _node_id, node_output in outputs.items():
-        images = node_output.get("images", [])
-        for img in images:
-            filename = img.get("filename", "")
-            subfolder = img.get("subfolder", "")
-            if filename:
-                full_path = os.path.join(COMFYUI_OUTPUT_DIR, subfolder, filename)
-                paths.append(full_path)
-    return paths
+    """Extract output image file paths (under COMFYUI_OUTPUT_DIR) from a history entry."""
+    return [_local_output_path(img) for img in output_images(history)]
+
+
+async def save_output_image(history: dict, image: dict, dest: Path) -> None:
+    """把一张输出图片保存到 dest：按 COMFYUI_RESULT_MODE 从本地目录复制或经 /view 下载。
+
+    本地模式下文件不存在时抛出 FileNotFoundError，而不是静默跳过。
+    """
+    if COMFYUI_RESULT_MODE == "view":
+        await comfy_client.download_image(history, image, dest)
+        return
+    src = _local_output_path(image)
+    if not await fileio.exists(src):
+        raise FileNotFoundError(f"ComfyUI 输出文件不存在: {src}")
+    await fileio.copy_file(src, dest)
+
+
+def extract_error(history: dict) -> str | None:
+    """从 history entry 中提取执行错误信息，无错误返回 None。"""
+    status = history.get("status") or {}
+    if status.get("status_str") != "error":
+        return None
+    for msg_type, data in status.get("messages", []):
+        if msg_type == "execution_error":
+            return f"{data.get('exception_type', '')}: {data.get('exception_message', '')}".strip(": ")
+    return "ComfyUI 执行失败"
 
 
 async def check_health() -> bool:
     """Check if ComfyUI is reachable."""
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"{COMFYUI_URL}/system_stats",
-                timeout=aiohttp.ClientTimeout(total=5),
-            ) as resp:
-                return resp.status == 200
-    except Exception:
-        return False
+    return await comfy_client.check_health()
@@ -1,15 +1,36 @@
+import asyncio
+import logging
 from collections.abc import AsyncGenerator
 import os
+from typing import Any
 
+from sqlalchemy import event, update
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base
 
+logger = logging.getLogger(__name__)
 
 DATABASE_URL = os.getenv(
     "DATABASE_URL",
     "sqlite+aiosqlite:///./game_asset_generator.db",
 )
 
+# SQLite 性能配置：WAL 让读写互不阻塞，多个 worker 写入时靠 busy_timeout 排队而非报错
+SQLITE_TUNED = os.getenv("SQLITE_TUNED", "1") != "0"
+SQLITE_PRAGMAS: dict[str, Any] = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    "cache_size": -int(os.getenv("SQLITE_CACHE_KB", "65536")),
+    "temp_store": "MEMORY",
+}
+
+# 合并写入的刷新间隔（秒）
+DB_WRITE_FLUSH_INTERVAL = float(os.getenv("DB_WRITE_FLUSH_INTERVAL", "0.5"))
+# 批量写入失败后按指数退避重试的最大间隔（秒）
+DB_WRITE_RETRY_MAX_DELAY = float(os.getenv("DB_WRITE_RETRY_MAX_DELAY", "30"))
+
 engine = create_async_engine(DATABASE_URL, echo=False)
 AsyncSessionLocal = async_sessionmaker(
     bind=engine,
@@ -19,6 +40,16 @@ AsyncSessionLocal = async_sessionmaker(
 Base = declarative_base()
 
 
+if engine.dialect.name == "sqlite" and SQLITE_TUNED:
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _apply_sqlite_pragmas(dbapi_connection, _connection_record) -> None:
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
     async with AsyncSessionLocal() as session:
         yield session
@@ -30,3 +61,88 @@ async def init_db() -> None:
 
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all, checkfirst=True)
+
+
+class CoalescingWriter:
+    """合并同一行的多次字段更新，定期在一个事务中批量写入。
+
+    update() 只记录待写字段（同字段后写覆盖先写），最多 interval 秒后统一刷新；
+    commit() 合并待写字段后立即刷新，用于最终状态等需要落盘后再继续的写入。
+    写入失败的数据留在队列中，由定时器按指数退避重试，不依赖之后是否还有新的 update()。
+    """
+
+    def __init__(
+        self,
+        session_maker: async_sessionmaker,
+        *,
+        interval: float = DB_WRITE_FLUSH_INTERVAL,
+    ) -> None:
+        self._session_maker = session_maker
+        self._interval = interval
+        self._pending: dict[tuple[type, int], dict[str, Any]] = {}
+        self._flush_lock = asyncio.Lock()
+        self._timer: asyncio.Task | None = None
+        self._stats = {"updates": 0, "rows_written": 0, "flushes": 0, "retries": 0}
+
+    def update(self, model: type, row_id: int, **values: Any) -> None:
+        self._pending.setdefault((model, row_id), {}).update(values)
+        self._stats["updates"] += 1
+        self._arm()
+
+    async def commit(self, model: type, row_id: int, **values: Any) -> None:
+        self._pending.setdefault((model, row_id), {}).update(values)
+        self._stats["updates"] += 1
+        try:
+            await self.flush()
+        except Exception:
+            # 调用方收到异常，待写数据仍由定时器重试
+            self._arm()
+            raise
+
+    def _arm(self) -> None:
+        if self._timer is None or self._timer.done():
+            self._timer = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self) -> None:
+        delay = self._interval
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.flush()
+                return
+            except Exception:
+                delay = min(max(delay, 0.5) * 2, DB_WRITE_RETRY_MAX_DELAY)
+                self._stats["retries"] += 1
+                logger.exception("批量写入数据库失败，%.1f 秒后重试", delay)
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            try:
+                async with self._session_maker() as session:
+                    for (model, row_id), values in batch.items():
+                        await session.execute(
+                            update(model).where(model.id == row_id).values(**values)
+                        )
+                    await session.commit()
+            except Exception:
+                # 写入失败时放回队列（不覆盖期间产生的新值），等待下次刷新
+                for key, values in batch.items():
+                    self._pending[key] = {**values, **self._pending.get(key, {})}
+                raise
+            self._stats["flushes"] += 1
+            self._stats["rows_written"] += len(batch)
+
+    async def close(self) -> None:
+        if self._timer is not None and not self._timer.done():
+            self._timer.cancel()
+        await self.flush()
+
+    def stats(self) -> dict[str, int]:
+        return {**self._stats, "pending": len(self._pending)}
+
+
+# 进程级共享的合并写入器（任务状态 / 进度 / 部分结果）
+status_writer = CoalescingWriter(AsyncSessionLocal)
@@ -0,0 +1,216 @@
+"""Content-addressed file store — 按内容哈希命名、去重并零拷贝交给 ComfyUI。
+
+- 上传文件以 sha256 前缀命名（<digest><ext>），相同内容只保存一份
+- 上传内容按块写盘：边读边计算哈希、边检查大小上限，写文件在 fileio 线程池中执行
+  （UploadFile 已由 Starlette 先行接收，过大的请求由 main.UploadBodyLimit 在接收阶段拒绝）
+- 交给 ComfyUI 的输入图以同名硬链接放入 ComfyUI/input（跨文件系统时
+  退化为符号链接，最后才完整复制），同一张图被多个任务引用也只占一份磁盘
+"""
+
+from __future__ import annotations
+
+import functools
+import hashlib
+import logging
+import os
+import re
+import shutil
+import struct
+import uuid
+from collections.abc import Awaitable, Callable
+from pathlib import Path
+from typing import BinaryIO
+
+from app import fileio
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent
+UPLOADS_DIR = PROJECT_ROOT / "uploads"
+COMFYUI_INPUT_DIR = PROJECT_ROOT / "ComfyUI" / "input"
+
+# 文件名中保留的哈希长度（128 bit）
+DIGEST_CHARS = 32
+_HASH_CHUNK = 1024 * 1024
+# 流式上传每次读取的块大小
+UPLOAD_CHUNK = 256 * 1024
+_CONTENT_NAME_RE = re.compile(rf"^[0-9a-f]{{{DIGEST_CHARS}}}\.[A-Za-z0-9]+$")
+
+
+def content_name(digest: str, ext: str) -> str:
+    return f"{digest[:DIGEST_CHARS]}{ext.lower()}"
+
+
+def is_content_name(name: str) -> bool:
+    return bool(_CONTENT_NAME_RE.match(name))
+
+
+@functools.lru_cache(maxsize=1024)
+def _hash_file_cached(path: str, _mtime_ns: int, _size: int) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(_HASH_CHUNK):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_file(path: Path) -> str:
+    """计算文件 sha256，按 (路径, mtime, size) 缓存。"""
+    st = path.stat()
+    return _hash_file_cached(str(path), st.st_mtime_ns, st.st_size)
+
+
+def link_file(src: Path, dest: Path) -> None:
+    """把 src 放到 dest：优先硬链接，其次符号链接，最后复制。dest 已存在则跳过。"""
+    if dest.exists():
+        return
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(src, dest)
+        return
+    except FileExistsError:
+        return
+    except OSError:
+        pass
+    try:
+        os.symlink(src.resolve(), dest)
+        return
+    except FileExistsError:
+        return
+    except OSError:
+        pass
+    tmp = dest.with_name(f".{dest.name}.{uuid.uuid4().hex[:8]}.tmp")
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dest)
+
+
+class UploadTooLarge(Exception):
+    """上传内容超过大小上限。"""
+
+    def __init__(self, max_size: int) -> None:
+        super().__init__(f"文件大小超过 {max_size // (1024 * 1024)}MB 限制")
+        self.max_size = max_size
+
+
+def _write_chunk(f: BinaryIO, digest: hashlib._Hash, chunk: bytes) -> None:
+    digest.update(chunk)
+    f.write(chunk)
+
+
+def _finalize_upload(tmp: Path, dest: Path) -> None:
+    if dest.exists():
+        tmp.unlink(missing_ok=True)
+    else:
+        os.replace(tmp, dest)
+
+
+class ContentStore:
+    """以内容哈希命名的文件目录。"""
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, name: str) -> Path:
+        return self.root / name
+
+    async def put_stream(
+        self,
+        read: Callable[[int], Awaitable[bytes]],
+        ext: str,
+        *,
+        max_size: int,
+    ) -> str:
+        """按块读取并写入临时文件，同一遍完成哈希与大小检查，返回文件名。
+
+        超过 max_size 时立即中止并抛出 UploadTooLarge；相同内容已存在时丢弃临时文件。
+        """
+        digest = hashlib.sha256()
+        size = 0
+        tmp = self.root / f".upload.{uuid.uuid4().hex}.tmp"
+        f = await fileio.run(open, tmp, "wb")
+        try:
+            while chunk := await read(UPLOAD_CHUNK):
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadTooLarge(max_size)
+                await fileio.run(_write_chunk, f, digest, chunk)
+            await fileio.run(f.close)
+        except BaseException:
+            await fileio.run(f.close)
+            await fileio.run(tmp.unlink, True)
+            raise
+
+        name = content_name(digest.hexdigest(), ext)
+        await fileio.run(_finalize_upload, tmp, self.path(name))
+        return name
+
+
+# JPEG 中携带图像尺寸的 SOF 标记（排除 DHT / JPG / DAC）
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def _jpeg_size(f: BinaryIO) -> tuple[int, int] | None:
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        while byte and byte != b"\xff":
+            byte = f.read(1)
+        while byte == b"\xff":
+            byte = f.read(1)
+        if not byte or byte[0] == 0xDA:
+            return None
+        marker = byte[0]
+        header = f.read(2)
+        if len(header) < 2:
+            return None
+        if marker in _JPEG_SOF_MARKERS:
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            height, width = struct.unpack(">HH", data[1:5])
+            return width, height
+        f.seek(struct.unpack(">H", header)[0] - 2, os.SEEK_CUR)
+
+
+def image_size(path: Path) -> tuple[int, int] | None:
+    """只读文件头得到 PNG / JPEG / WebP 图片的 (宽, 高)，无法识别时返回 None。"""
+    with open(path, "rb") as f:
+        head = f.read(30)
+        if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP" and len(head) >= 30:
+            chunk = head[12:16]
+            if chunk == b"VP8 ":
+                return (
+                    int.from_bytes(head[26:28], "little") & 0x3FFF,
+                    int.from_bytes(head[28:30], "little") & 0x3FFF,
+                )
+            if chunk == b"VP8L":
+                bits = int.from_bytes(head[21:25], "little")
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+            if chunk == b"VP8X":
+                return (
+                    int.from_bytes(head[24:27], "little") + 1,
+                    int.from_bytes(head[27:30], "little") + 1,
+                )
+            return None
+        if head[:2] == b"\xff\xd8":
+            return _jpeg_size(f)
+    return None
+
+
+def input_name(src: Path) -> str:
+    """本地图片在 ComfyUI 中使用的文件名（内容哈希）；已按内容命名的文件直接沿用原名。"""
+    return src.name if is_content_name(src.name) else content_name(hash_file(src), src.suffix)
+
+
+def stage_input(src: Path, input_dir: Path = COMFYUI_INPUT_DIR) -> str:
+    """把本地图片交给 ComfyUI/input，返回 LoadImage 节点使用的文件名。"""
+    name = input_name(src)
+    link_file(src, input_dir / name)
+    return name
+
+
+# 上传目录（/uploads 静态托管）
+upload_store = ContentStore(UPLOADS_DIR)
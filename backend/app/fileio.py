@@ -0,0 +1,45 @@
+"""Async file operations — 在有界线程池中执行阻塞的文件 I/O。
+
+任务 worker 与接口里的 copy / exists / mkdir / glob 等操作都通过这里执行，
+拷贝多 MB 的 PNG 时不会阻塞事件循环（WebSocket 进度推送等协程照常运行）；
+线程数由 FILE_IO_THREADS 限制，避免大量并发拷贝压垮磁盘。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import os
+import shutil
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, TypeVar
+
+T = TypeVar("T")
+
+FILE_IO_THREADS = int(os.getenv("FILE_IO_THREADS", "4"))
+
+_executor = ThreadPoolExecutor(max_workers=FILE_IO_THREADS, thread_name_prefix="fileio")
+
+
+async def run(fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """在文件 I/O 线程池中执行 fn(*args, **kwargs)。"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+
+async def copy_file(src: str | Path, dest: str | Path) -> None:
+    await run(shutil.copy2, str(src), str(dest))
+
+
+async def exists(path: str | Path) -> bool:
+    return await run(os.path.exists, path)
+
+
+async def mkdir(path: Path) -> None:
+    await run(path.mkdir, parents=True, exist_ok=True)
+
+
+async def glob(directory: Path, pattern: str) -> list[Path]:
+    return await run(lambda: list(directory.glob(pattern)))
@@ -0,0 +1,132 @@
+"""Adaptive GPU cache clearing — 按显存压力决定是否调用 ComfyUI /free。
+
+原先每帧之间和每次重试前都会 /free，迫使 ComfyUI 重新分配本可复用的缓存。
+现在只在以下情况释放：
+- /system_stats 报告的显存占用率达到 GPU_FREE_THRESHOLD
+- 失败原因看起来是显存不足（OOM）
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import re
+import time
+from typing import Any
+
+from app.comfyui_client import ComfyUIClient, ComfyUIPool, comfy_client
+
+logger = logging.getLogger(__name__)
+
+# 显存占用率阈值（0~1），超过即释放缓存
+GPU_FREE_THRESHOLD = float(os.getenv("GPU_FREE_THRESHOLD", "0.85"))
+# 两次 /system_stats 查询的最小间隔（秒）
+GPU_STATS_MIN_INTERVAL = float(os.getenv("GPU_STATS_MIN_INTERVAL", "2"))
+
+# 只匹配明确的显存不足信息："out of memory"（含 "CUDA error: out of memory"、
+# "MPS backend out of memory"）、torch 的 OutOfMemoryError、分配失败，以及独立成词的
+# "OOM"；不能用裸子串 "oom"，否则 "room" / "zoom" 之类的报错也会触发 /free
+_OOM_PATTERN = re.compile(
+    r"out of memory|outofmemory|failed to allocate|\boom\b",
+    re.IGNORECASE,
+)
+
+
+def looks_like_oom(error: BaseException | str | None) -> bool:
+    return _OOM_PATTERN.search(str(error or "")) is not None
+
+
+def _vram_free_and_usage(stats: dict) -> tuple[int, float]:
+    """返回 (各设备空闲显存总和, 最高占用率)。"""
+    free_total = 0
+    usage = 0.0
+    for device in stats.get("devices", []):
+        total = device.get("vram_total") or 0
+        free = device.get("vram_free") or 0
+        free_total += free
+        if total:
+            usage = max(usage, 1.0 - free / total)
+    return free_total, usage
+
+
+class GpuCachePolicy:
+    """显存压力感知的 /free 策略，附带触发次数与回收量计数。"""
+
+    def __init__(
+        self,
+        client: ComfyUIClient | ComfyUIPool,
+        *,
+        threshold: float = GPU_FREE_THRESHOLD,
+        min_interval: float = GPU_STATS_MIN_INTERVAL,
+    ) -> None:
+        self._client = client
+        self._threshold = threshold
+        self._min_interval = min_interval
+        self._last_check = 0.0
+        self._counters: dict[str, Any] = {
+            "checks": 0,
+            "skipped": 0,
+            "freed_threshold": 0,
+            "freed_oom": 0,
+            "reclaimed_bytes": 0,
+            "last_usage": None,
+        }
+
+    async def maybe_free(self) -> bool:
+        """显存占用超过阈值时释放缓存，返回是否调用了 /free。"""
+        now = time.monotonic()
+        if now - self._last_check < self._min_interval:
+            self._counters["skipped"] += 1
+            return False
+        self._last_check = now
+
+        try:
+            stats = await self._client.system_stats()
+        except Exception as exc:
+            logger.debug("获取 system_stats 失败: %s", exc)
+            return False
+        self._counters["checks"] += 1
+        free_before, usage = _vram_free_and_usage(stats)
+        self._counters["last_usage"] = round(usage, 3)
+
+        if usage < self._threshold:
+            return False
+        return await self._free("freed_threshold", free_before)
+
+    async def after_failure(self, error: BaseException | str | None) -> bool:
+        """失败后调用：OOM 类错误无条件释放，其他错误按阈值判断。"""
+        if not looks_like_oom(error):
+            return await self.maybe_free()
+
+        free_before: int | None = None
+        try:
+            free_before, _ = _vram_free_and_usage(await self._client.system_stats())
+        except Exception:
+            pass
+        return await self._free("freed_oom", free_before)
+
+    async def _free(self, counter: str, free_before: int | None) -> bool:
+        try:
+            if not await self._client.free_memory():
+                return False
+        except Exception as exc:
+            logger.debug("GPU 缓存清理失败: %s", exc)
+            return False
+        self._counters[counter] += 1
+
+        # /free 由 ComfyUI 异步执行，这里的回收量只是近似值
+        if free_before is not None:
+            try:
+                free_after, _ = _vram_free_and_usage(await self._client.system_stats())
+                self._counters["reclaimed_bytes"] += max(free_after - free_before, 0)
+            except Exception:
+                pass
+        logger.debug("GPU 缓存已清理 (%s)", counter)
+        return True
+
+    def stats(self) -> dict[str, Any]:
+        return {"threshold": self._threshold, **self._counters}
+
+
+# 进程级共享策略
+gpu_cache_policy = GpuCachePolicy(comfy_client)
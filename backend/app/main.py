@@ -1,26 +1,53 @@
+import asyncio
+import base64
+import json
 import logging
-import uuid
 from contextlib import asynccontextmanager
+from datetime import datetime
 from pathlib import Path
-
-from fastapi import Depends, FastAPI, Form, HTTPException, UploadFile, WebSocket, WebSocketDisconnect
+from typing import Literal
+
+from fastapi import (
+    Depends,
+    FastAPI,
+    Form,
+    HTTPException,
+    Query,
+    Response,
+    UploadFile,
+    WebSocket,
+    WebSocketDisconnect,
+)
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
 from fastapi.staticfiles import StaticFiles
-from sqlalchemy import select, text
+from sqlalchemy import String, cast, literal, null, select, text, tuple_, union_all
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from app import fileio
+from app.backplane import create_backplane
 from app.comfyui_client import (
     build_controlnet_preview_workflow,
     check_health as comfy_health_check,
-    extract_image_paths,
+    comfy_client,
+    controlnet_preprocess_params,
+    output_images,
     queue_prompt,
+    resolve_remove_bg_model,
+    save_output_image,
+    stage_input_image,
     wait_for_completion,
 )
-from app.database import AsyncSessionLocal, engine, get_session, init_db
+from app.database import AsyncSessionLocal, Base, engine, get_session, init_db, status_writer
+from app.file_store import UploadTooLarge, image_size, upload_store
+from app.gpu_memory import gpu_cache_policy
 from app.models import BackgroundRemovalTask, GenerationTask, Style, TrainingJob
 from app.progress import ProgressHub
+from app.result_cache import control_map_cache, control_map_key, result_cache
+from app.scheduler import SchedulerLock, TaskScheduler, gpu_gate
 from app.schemas import (
+    BackgroundRemovalBatchCreate,
+    BackgroundRemovalBatchRead,
     BackgroundRemovalCreate,
     BackgroundRemovalRead,
     GenerationTaskCreate,
@@ -32,11 +59,22 @@ from app.schemas import (
     TrainingJobCreate,
     TrainingJobRead,
 )
-from app.task_runner import run_generation_task, run_remove_bg_task, run_training_job
+from app.task_runner import (
+    dispatch_loop,
+    register_workers,
+    remove_bg_batch_status,
+    remove_bg_latency,
+    run_generation_task,
+    run_remove_bg_task,
+    run_training_job,
+)
 
 logger = logging.getLogger(__name__)
 
-progress_hub = ProgressHub()
+progress_hub = ProgressHub(backplane=create_backplane())
+# 持久化任务只由持有调度锁的进程执行（见 dispatch_loop）
+scheduler = TaskScheduler(dispatching=False)
+scheduler_lock = SchedulerLock()
 
 # 目录
 PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent
@@ -60,6 +98,10 @@ async def _migrate_columns() -> None:
         ("generation_tasks", "controlnet_config", "JSON"),
         # 新增
         ("training_jobs", "training_backend", "VARCHAR(32) DEFAULT 'mflux'"),
+        ("generation_tasks", "progress", "FLOAT NOT NULL DEFAULT 0"),
+        ("background_removal_tasks", "progress", "FLOAT NOT NULL DEFAULT 0"),
+        ("background_removal_tasks", "batch_id", "INTEGER"),
+        ("generation_tasks", "remove_background", "BOOLEAN NOT NULL DEFAULT 0"),
     ]
     async with engine.begin() as conn:
         for table, column, definition in migrations:
@@ -72,6 +114,18 @@ async def _migrate_columns() -> None:
                 logger.info("已迁移: %s.%s", table, column)
 
 
+async def _migrate_indexes() -> None:
+    """为已有表补建模型中声明的索引（create_all 不会给已存在的表加索引）。"""
+
+    def _create_missing(sync_conn) -> None:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(sync_conn, checkfirst=True)
+
+    async with engine.begin() as conn:
+        await conn.run_sync(_create_missing)
+
+
 async def _init_base_style() -> None:
     """确保系统中存在基础风格（开箱即用，无 LoRA）。"""
     async with AsyncSessionLocal() as session:
@@ -95,8 +149,26 @@ async def _init_base_style() -> None:
 async def lifespan(_: FastAPI):
     await init_db()
     await _migrate_columns()
+    await _migrate_indexes()
     await _init_base_style()
-    yield
+    await comfy_client.start()
+    await progress_hub.start()
+    register_workers(scheduler, session_maker=AsyncSessionLocal, progress_hub=progress_hub)
+    await scheduler.start()
+    dispatcher = asyncio.create_task(
+        dispatch_loop(scheduler, scheduler_lock, session_maker=AsyncSessionLocal),
+        name="task-dispatcher",
+    )
+    try:
+        yield
+    finally:
+        dispatcher.cancel()
+        await asyncio.gather(dispatcher, return_exceptions=True)
+        await scheduler.stop()
+        scheduler_lock.release()
+        await status_writer.close()
+        await progress_hub.close()
+        await comfy_client.close()
 
 
 app = FastAPI(
@@ -112,6 +184,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # 任务列表的分页游标放在响应头里，跨域时需显式暴露给前端
+    expose_headers=["X-Next-Cursor"],
 )
 
 
@@ -127,6 +201,22 @@ async def health() -> dict:
     }
 
 
+@app.get("/api/metrics")
+async def metrics() -> dict:
+    """运行时指标：任务队列、GPU 闸门占用、ComfyUI 后端负载、显存清理、结果缓存、各抠图模型耗时、数据库合并写入与进度推送计数。"""
+    return {
+        "scheduler": scheduler.stats(),
+        "gpu_gate": gpu_gate.stats(),
+        "comfyui": comfy_client.stats(),
+        "gpu_cache": gpu_cache_policy.stats(),
+        "result_cache": result_cache.stats(),
+        "controlnet_cache": control_map_cache.stats(),
+        "remove_bg_models": remove_bg_latency.stats(),
+        "db_writer": status_writer.stats(),
+        "progress": progress_hub.stats(),
+    }
+
+
 # ---------- 风格管理 ----------
 
 
@@ -215,11 +305,7 @@ async def start_training(
     await session.commit()
     await session.refresh(job)
 
-    run_training_job(
-        session_maker=AsyncSessionLocal,
-        progress_hub=progress_hub,
-        job_id=job.id,
-    )
+    run_training_job(scheduler=scheduler, job_id=job.id)
     return job
 
 
@@ -240,6 +326,84 @@ async def get_training_job(
 
 ALLOWED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
 MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10MB
+# multipart 请求中文件以外的开销（边界、头部、表单字段）
+_UPLOAD_FORM_OVERHEAD = 64 * 1024
+_UPLOAD_PATHS = frozenset({"/api/upload", "/api/controlnet/preview"})
+_UPLOAD_TOO_LARGE_BODY = json.dumps({"detail": "文件大小超过 10MB 限制"}, ensure_ascii=False).encode()
+
+
+class UploadBodyLimit:
+    """上传接口的请求体大小限制（ASGI 中间件）。
+
+    UploadFile 参数在处理函数执行前已被完整接收，处理函数内的检查无法阻止过大的上传；
+    这里在接收请求体之前按 Content-Length 直接返回 413，没有 Content-Length（分块传输）
+    时按已接收字节数中止，不再读取剩余内容。文件本身的精确上限仍由 put_stream 检查。
+    """
+
+    def __init__(self, app, *, max_body: int = MAX_UPLOAD_SIZE + _UPLOAD_FORM_OVERHEAD) -> None:
+        self.app = app
+        self.max_body = max_body
+
+    async def _reject(self, send) -> None:
+        body = _UPLOAD_TOO_LARGE_BODY
+        await send({
+            "type": "http.response.start",
+            "status": 413,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http" or scope["path"] not in _UPLOAD_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_body:
+            await self._reject(send)
+            return
+
+        received = 0
+        exceeded = False
+        started = False
+
+        async def limited_receive():
+            nonlocal received, exceeded
+            if exceeded:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body:
+                    exceeded = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def guarded_send(message) -> None:
+            nonlocal started
+            # 超限后应用因读取中断产生的响应（400 等）替换为 413
+            if exceeded:
+                if not started:
+                    started = True
+                    await self._reject(send)
+                return
+            started = started or message["type"] == "http.response.start"
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not exceeded:
+                raise
+        if exceeded and not started:
+            await self._reject(send)
+
+
+app.add_middleware(UploadBodyLimit)
 
 
 @app.post("/api/upload")
@@ -255,18 +419,15 @@ async def upload_image(file: UploadFile) -> dict:
             detail=f"不支持的文件格式: {ext}，支持 {', '.join(ALLOWED_EXTENSIONS)}",
         )
 
-    content = await file.read()
-    if len(content) > MAX_UPLOAD_SIZE:
-        raise HTTPException(status_code=400, detail="文件大小超过 10MB 限制")
-
-    # 生成唯一文件名，避免冲突
-    unique_name = f"{uuid.uuid4().hex[:12]}{ext}"
-    dest = UPLOADS_DIR / unique_name
-    dest.write_bytes(content)
+    # 流式写盘并按内容哈希命名，重复上传同一张图只保存一份
+    try:
+        stored_name = await upload_store.put_stream(file.read, ext, max_size=MAX_UPLOAD_SIZE)
+    except UploadTooLarge as exc:
+        raise HTTPException(status_code=400, detail="文件大小超过 10MB 限制") from exc
 
-    url_path = f"/uploads/{unique_name}"
+    url_path = f"/uploads/{stored_name}"
     logger.info("已上传文件: %s -> %s", file.filename, url_path)
-    return {"url": url_path, "filename": unique_name}
+    return {"url": url_path, "filename": stored_name}
 
 
 # ---------- 生成中心 ----------
@@ -288,17 +449,24 @@ async def generate(
     await session.commit()
     await session.refresh(task)
 
-    run_generation_task(
-        session_maker=AsyncSessionLocal,
-        progress_hub=progress_hub,
-        task_id=task.id,
-    )
+    run_generation_task(scheduler=scheduler, task_id=task.id)
     return task
 
 
 # ---------- 抠图中心 ----------
 
 
+async def _resolve_remove_bg_model(model: str, input_image: str) -> str:
+    """解析请求的抠图模型；auto 时读取图片尺寸（只读文件头），文件不可读时用快速模型。"""
+    if model != "auto":
+        return resolve_remove_bg_model(model, None)
+    try:
+        size = await fileio.run(image_size, PROJECT_ROOT / input_image.lstrip("/"))
+    except OSError:
+        size = None
+    return resolve_remove_bg_model(model, size)
+
+
 @app.post("/api/remove-bg", response_model=BackgroundRemovalRead)
 async def remove_background(
     payload: BackgroundRemovalCreate,
@@ -306,7 +474,7 @@ async def remove_background(
 ) -> BackgroundRemovalTask:
     task = BackgroundRemovalTask(
         input_image=payload.input_image,
-        model=payload.model,
+        model=await _resolve_remove_bg_model(payload.model, payload.input_image),
         source_task_id=payload.source_task_id,
         status="queued",
     )
@@ -314,14 +482,80 @@ async def remove_background(
     await session.commit()
     await session.refresh(task)
 
-    run_remove_bg_task(
-        session_maker=AsyncSessionLocal,
-        progress_hub=progress_hub,
-        task_id=task.id,
-    )
+    run_remove_bg_task(scheduler=scheduler, task_id=task.id, model=task.model)
     return task
 
 
+def _batch_read(batch_id: int, tasks: list[BackgroundRemovalTask]) -> BackgroundRemovalBatchRead:
+    return BackgroundRemovalBatchRead(
+        batch_id=batch_id,
+        status=remove_bg_batch_status([t.status for t in tasks]),
+        progress=round(sum(t.progress or 0.0 for t in tasks) / len(tasks), 1),
+        source_task_id=tasks[0].source_task_id,
+        tasks=[BackgroundRemovalRead.model_validate(t) for t in tasks],
+    )
+
+
+@app.post("/api/remove-bg/batch", response_model=BackgroundRemovalBatchRead)
+async def remove_background_batch(
+    payload: BackgroundRemovalBatchCreate,
+    session: AsyncSession = Depends(get_session),
+) -> BackgroundRemovalBatchRead:
+    """批量抠图：每张图片一行任务，整个批次由一个 worker 分块处理。
+
+    只给 source_task_id 时取该生成任务的全部输出；进度通过 WebSocket 以
+    kind=remove_bg_batch、id=batch_id 汇总推送。
+    """
+    input_images = payload.input_images
+    if not input_images and payload.source_task_id is not None:
+        source = await session.get(GenerationTask, payload.source_task_id)
+        if not source:
+            raise HTTPException(status_code=404, detail="生成任务不存在")
+        input_images = list(source.output_paths or [])
+    if not input_images:
+        raise HTTPException(status_code=400, detail="没有需要抠图的图片")
+
+    models = await asyncio.gather(*(
+        _resolve_remove_bg_model(payload.model, image) for image in input_images
+    ))
+    tasks = [
+        BackgroundRemovalTask(
+            input_image=image,
+            model=model,
+            source_task_id=payload.source_task_id,
+            status="queued",
+        )
+        for image, model in zip(input_images, models)
+    ]
+    session.add_all(tasks)
+    await session.flush()
+    # 批次 id 取首行 id
+    batch_id = tasks[0].id
+    for task in tasks:
+        task.batch_id = batch_id
+    await session.commit()
+
+    # 批次按首张图片的模型分组入队（批次内各模型的图片分别成块处理）
+    run_remove_bg_task(scheduler=scheduler, task_id=batch_id, model=tasks[0].model)
+    return _batch_read(batch_id, tasks)
+
+
+@app.get("/api/remove-bg/batch/{batch_id}", response_model=BackgroundRemovalBatchRead)
+async def get_remove_bg_batch(
+    batch_id: int,
+    session: AsyncSession = Depends(get_session),
+) -> BackgroundRemovalBatchRead:
+    result = await session.execute(
+        select(BackgroundRemovalTask)
+        .where(BackgroundRemovalTask.batch_id == batch_id)
+        .order_by(BackgroundRemovalTask.id)
+    )
+    tasks = list(result.scalars().all())
+    if not tasks:
+        raise HTTPException(status_code=404, detail="抠图批次不存在")
+    return _batch_read(batch_id, tasks)
+
+
 @app.get("/api/remove-bg/{task_id}", response_model=BackgroundRemovalRead)
 async def get_remove_bg_task(
     task_id: int,
@@ -355,45 +589,44 @@ async def controlnet_preview(
     if not image.filename:
         raise HTTPException(status_code=400, detail="文件名为空")
 
-    # 保存上传图片到 uploads/
-    content = await image.read()
+    # 保存上传图片到 uploads/（内容寻址）
     ext = Path(image.filename).suffix.lower()
-    unique_name = f"ctrl_{uuid.uuid4().hex[:12]}{ext}"
-    dest = UPLOADS_DIR / unique_name
-    dest.write_bytes(content)
-
-    # 复制到 ComfyUI input 目录
-    import shutil
-    comfyui_input_dir = PROJECT_ROOT / "ComfyUI" / "input"
-    comfyui_input_dir.mkdir(parents=True, exist_ok=True)
-    comfyui_dest = comfyui_input_dir / unique_name
-    shutil.copy2(str(dest), str(comfyui_dest))
-
-    # 构建预处理预览工作流
-    workflow = build_controlnet_preview_workflow(
-        image_name=unique_name,
-        control_type=control_type,
-    )
-
     try:
-        prompt_id = await queue_prompt(workflow)
-        history = await wait_for_completion(prompt_id, timeout=60)
-        image_paths = extract_image_paths(history)
+        stored_name = await upload_store.put_stream(image.read, ext, max_size=MAX_UPLOAD_SIZE)
+    except UploadTooLarge as exc:
+        raise HTTPException(status_code=400, detail="文件大小超过 10MB 限制") from exc
 
-        if not image_paths:
+    # 预处理图按 (图片内容哈希, 控制类型, 预处理参数) 缓存，生成任务也会复用
+    cache_key = control_map_key(
+        stored_name, control_type, controlnet_preprocess_params(control_type)
+    )
+    out_name = f"preview_{cache_key[:32]}.png"
+    out_path = OUTPUTS_DIR / out_name
+    if await control_map_cache.get(cache_key, 1, [out_path]):
+        return {"preview_url": f"/outputs/{out_name}"}
+
+    async def _run_preview() -> dict:
+        image_name = await stage_input_image(upload_store.path(stored_name))
+        workflow = build_controlnet_preview_workflow(
+            image_name=image_name,
+            control_type=control_type,
+        )
+        async with gpu_gate.slot("preview"):
+            prompt_id = await queue_prompt(workflow)
+            history = await wait_for_completion(prompt_id, timeout=60)
+        images = output_images(history)
+
+        if not images:
             raise RuntimeError("预处理未产出结果图片")
 
-        # 复制预览图到 outputs/
-        import os
-        served_paths: list[str] = []
-        for src in image_paths:
-            if os.path.exists(src):
-                filename = Path(src).name
-                out_dest = OUTPUTS_DIR / f"preview_{unique_name}_{filename}"
-                shutil.copy2(src, str(out_dest))
-                served_paths.append(f"/outputs/{out_dest.name}")
+        # 保存预览图到 outputs/ 并放入预处理图缓存
+        await save_output_image(history, images[0], out_path)
+        await control_map_cache.put(cache_key, [out_path])
+
+        return {"preview_url": f"/outputs/{out_name}"}
 
-        return {"preview_url": served_paths[0] if served_paths else None}
+    try:
+        return await scheduler.run("preview", _run_preview)
 
     except Exception as exc:
         logger.exception("ControlNet 预处理预览失败")
@@ -421,47 +654,110 @@ async def get_task(
 # ---------- 任务列表 ----------
 
 
+TASK_LIST_MAX_LIMIT = 500
+
+
+def _encode_task_cursor(item: TaskListItem) -> str:
+    raw = f"{item.created_at.isoformat()}|{item.task_kind}|{item.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_task_cursor(cursor: str) -> tuple[datetime, str, int]:
+    try:
+        created_at, kind, task_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), kind, int(task_id)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail="无效的分页游标") from exc
+
+
 @app.get("/api/tasks", response_model=list[TaskListItem])
 async def list_tasks(
+    response: Response,
+    kind: list[Literal["training", "generation", "remove_bg"]] | None = Query(default=None),
+    status: list[str] | None = Query(default=None),
+    limit: int = Query(default=100, ge=1, le=TASK_LIST_MAX_LIMIT),
+    cursor: str | None = None,
     session: AsyncSession = Depends(get_session),
 ) -> list[TaskListItem]:
-    training_result = await session.execute(select(TrainingJob))
-    generation_result = await session.execute(select(GenerationTask))
-    rmbg_result = await session.execute(select(BackgroundRemovalTask))
-
-    training_items = [
-        TaskListItem(
-            id=i.id,
-            task_kind="training",
-            status=i.status,
-            created_at=i.created_at,
-            progress=i.progress,
-        )
-        for i in training_result.scalars().all()
+    """任务列表（训练 + 生成 + 抠图），按创建时间倒序的键集分页。
+
+    三张表在数据库内 UNION ALL 合并，每个分支只取 limit+1 行并走
+    (status, created_at) / created_at 索引；下一页游标通过 X-Next-Cursor 响应头返回。
+    """
+    after = _decode_task_cursor(cursor) if cursor else None
+
+    arms = [
+        ("training", TrainingJob, null()),
+        ("generation", GenerationTask, null()),
+        ("remove_bg", BackgroundRemovalTask, BackgroundRemovalTask.output_image),
     ]
-    generation_items = [
-        TaskListItem(
-            id=i.id,
-            task_kind="generation",
-            status=i.status,
-            created_at=i.created_at,
-            output_paths=i.output_paths,
+    subqueries = []
+    for arm_kind, model, output_col in arms:
+        if kind and arm_kind not in kind:
+            continue
+        query = select(
+            literal(arm_kind).label("task_kind"),
+            model.id.label("id"),
+            model.status.label("status"),
+            model.created_at.label("created_at"),
+            model.progress.label("progress"),
+            cast(output_col, String).label("output_image"),
         )
-        for i in generation_result.scalars().all()
-    ]
-    rmbg_items = [
-        TaskListItem(
-            id=i.id,
-            task_kind="remove_bg",
-            status=i.status,
-            created_at=i.created_at,
-            output_paths=[i.output_image] if i.output_image else [],
+        if status:
+            query = query.where(model.status.in_(status))
+        if after:
+            # 排序键 (created_at, task_kind, id) 倒序，按分支换算为各自的键集条件
+            after_ts, after_kind, after_id = after
+            if arm_kind < after_kind:
+                query = query.where(model.created_at <= after_ts)
+            elif arm_kind > after_kind:
+                query = query.where(model.created_at < after_ts)
+            else:
+                query = query.where(tuple_(model.created_at, model.id) < tuple_(after_ts, after_id))
+        query = query.order_by(model.created_at.desc(), model.id.desc()).limit(limit + 1)
+        subqueries.append(select(query.subquery()))
+
+    if not subqueries:
+        return []
+
+    merged = union_all(*subqueries).subquery()
+    result = await session.execute(
+        select(merged)
+        .order_by(merged.c.created_at.desc(), merged.c.task_kind.desc(), merged.c.id.desc())
+        .limit(limit + 1)
+    )
+    rows = result.all()
+
+    # 只为当前页的生成任务加载 output_paths
+    generation_ids = [r.id for r in rows[:limit] if r.task_kind == "generation"]
+    generation_outputs: dict[int, list[str]] = {}
+    if generation_ids:
+        outputs_result = await session.execute(
+            select(GenerationTask.id, GenerationTask.output_paths)
+            .where(GenerationTask.id.in_(generation_ids))
         )
-        for i in rmbg_result.scalars().all()
-    ]
-    merged = training_items + generation_items + rmbg_items
-    merged.sort(key=lambda x: x.created_at, reverse=True)
-    return merged
+        generation_outputs = {task_id: paths for task_id, paths in outputs_result.all()}
+
+    items: list[TaskListItem] = []
+    for r in rows[:limit]:
+        if r.task_kind == "generation":
+            output_paths = generation_outputs.get(r.id, [])
+        elif r.task_kind == "remove_bg":
+            output_paths = [r.output_image] if r.output_image else []
+        else:
+            output_paths = None
+        items.append(TaskListItem(
+            id=r.id,
+            task_kind=r.task_kind,
+            status=r.status,
+            created_at=r.created_at,
+            progress=r.progress,
+            output_paths=output_paths,
+        ))
+
+    if len(rows) > limit:
+        response.headers["X-Next-Cursor"] = _encode_task_cursor(items[-1])
+    return items
 
 
 # ---------- WebSocket 实时进度 ----------
@@ -472,7 +768,8 @@ async def ws_progress(websocket: WebSocket) -> None:
     await progress_hub.connect(websocket)
     try:
         while True:
-            await websocket.receive_text()
+            text = await websocket.receive_text()
+            await progress_hub.handle_message(websocket, text)
     except WebSocketDisconnect:
         await progress_hub.disconnect(websocket)
     except Exception:
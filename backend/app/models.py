@@ -1,6 +1,6 @@
 from datetime import datetime, timezone
 
-from sqlalchemy import Boolean, DateTime, Float, ForeignKey, Integer, JSON, String, Text
+from sqlalchemy import Boolean, DateTime, Float, ForeignKey, Index, Integer, JSON, String, Text
 from sqlalchemy.orm import Mapped, mapped_column
 
 from app.database import Base
@@ -26,13 +26,18 @@ class Style(Base):
 
 class TrainingJob(Base):
     __tablename__ = "training_jobs"
+    # /api/tasks 键集分页：按创建时间倒序，可按状态过滤
+    __table_args__ = (
+        Index("ix_training_jobs_created_at_id", "created_at", "id"),
+        Index("ix_training_jobs_status_created_at", "status", "created_at"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
     style_id: Mapped[int | None] = mapped_column(ForeignKey("styles.id"), nullable=True)
     dataset_path: Mapped[str] = mapped_column(String(512), nullable=False)
     status: Mapped[str] = mapped_column(String(32), default="queued")
     params: Mapped[dict] = mapped_column(JSON, default=dict)
-    progress: Mapped[float] = mapped_column(Float, default=0.0)
+    progress: Mapped[float] = mapped_column(Float, default=0.0)  # 0~100
     output_lora_path: Mapped[str | None] = mapped_column(String(512), nullable=True)
     training_backend: Mapped[str] = mapped_column(String(32), default="mflux", server_default="mflux")
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
@@ -40,6 +45,11 @@ class TrainingJob(Base):
 
 class GenerationTask(Base):
     __tablename__ = "generation_tasks"
+    # /api/tasks 键集分页：按创建时间倒序，可按状态过滤
+    __table_args__ = (
+        Index("ix_generation_tasks_created_at_id", "created_at", "id"),
+        Index("ix_generation_tasks_status_created_at", "status", "created_at"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
     style_id: Mapped[int | None] = mapped_column(ForeignKey("styles.id"), nullable=True)
@@ -53,6 +63,8 @@ class GenerationTask(Base):
 
     # 功能参数
     batch_size: Mapped[int] = mapped_column(Integer, default=1, nullable=False, server_default="1")
+    # 生成后在同一 prompt 内串接 BiRefNet 抠图，透明图记录为关联的 BackgroundRemovalTask
+    remove_background: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False, server_default="0")
 
     # ControlNet 配置 (JSON 存储)
     # { "enabled": true, "type": "canny", "image": "...", "strength": 0.8 }
@@ -60,6 +72,7 @@ class GenerationTask(Base):
 
     # 状态: queued, running, completed, failed, partial
     status: Mapped[str] = mapped_column(String(32), default="queued")
+    progress: Mapped[float] = mapped_column(Float, default=0.0, server_default="0")  # 0~100
     output_paths: Mapped[list[str]] = mapped_column(JSON, default=list)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
 
@@ -77,12 +90,20 @@ class Dataset(Base):
 
 class BackgroundRemovalTask(Base):
     __tablename__ = "background_removal_tasks"
+    # /api/tasks 键集分页：按创建时间倒序，可按状态过滤
+    __table_args__ = (
+        Index("ix_background_removal_tasks_created_at_id", "created_at", "id"),
+        Index("ix_background_removal_tasks_status_created_at", "status", "created_at"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
     input_image: Mapped[str] = mapped_column(String(512), nullable=False)
     output_image: Mapped[str | None] = mapped_column(String(512), nullable=True)
     model: Mapped[str] = mapped_column(String(64), default="birefnet", server_default="birefnet")
     status: Mapped[str] = mapped_column(String(32), default="queued")
+    progress: Mapped[float] = mapped_column(Float, default=0.0, server_default="0")  # 0~100
     source_task_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    # 批量抠图：同一批次的行共享 batch_id（取批次首行的 id），由一个 worker 分块处理
+    batch_id: Mapped[int | None] = mapped_column(Integer, nullable=True, index=True)
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=utcnow)
     completed_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True), nullable=True)
@@ -1,33 +1,303 @@
 import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, NamedTuple
+
 from fastapi import WebSocket
 
+try:  # 可选依赖：安装 orjson 时用它编码进度消息
+    import orjson
+except ImportError:
+    orjson = None
+
+from app.backplane import Backplane, LocalBackplane
+from app.database import CoalescingWriter
+
+logger = logging.getLogger(__name__)
+
+# 进度推送的最小时间间隔（秒），变化量达到 min_delta 时不受此限制
+PROGRESS_MIN_INTERVAL = float(os.getenv("PROGRESS_MIN_INTERVAL", "1.0"))
+# 每个连接待发送的任务数上限（同一任务只保留最新一条），超过即视为慢消费者断开
+PROGRESS_QUEUE_MAX = int(os.getenv("PROGRESS_QUEUE_MAX", "256"))
+# 一批消息的发送超时（秒），超时同样断开
+PROGRESS_SEND_TIMEOUT = float(os.getenv("PROGRESS_SEND_TIMEOUT", "10"))
+# 发送协程被唤醒后等待的合并窗口（秒），窗口内同一任务的多条消息只发最新一条
+PROGRESS_FLUSH_INTERVAL = float(os.getenv("PROGRESS_FLUSH_INTERVAL", "0.05"))
+
+# 终态消息：合并时不会被后续的 running 消息覆盖
+_TERMINAL_STATUSES = frozenset({"completed", "failed", "partial"})
+
+Topic = tuple[str, int | None]
+
+
+def encode_payload(payload: dict) -> str:
+    """把进度消息编码为 WebSocket 文本帧（与 send_json 的输出格式一致）。"""
+    if orjson is not None:
+        return orjson.dumps(payload).decode()
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+
+
+class _Frame(NamedTuple):
+    """已编码的消息，一次广播内所有连接共享同一个对象。"""
+
+    text: str
+    terminal: bool
+
+
+def _parse_topics(raw: Any) -> set[Topic]:
+    """解析 [{"kind": "generation", "id": 3}, {"kind": "training"}] 形式的订阅列表。"""
+    topics: set[Topic] = set()
+    if not isinstance(raw, list):
+        return topics
+    for item in raw:
+        if not isinstance(item, dict) or not isinstance(item.get("kind"), str):
+            continue
+        task_id = item.get("id")
+        if task_id is not None and not isinstance(task_id, int):
+            continue
+        topics.add((item["kind"], task_id))
+    return topics
+
+
+class _Subscriber:
+    """单个 WebSocket 连接：订阅集合 + 按任务合并的有界发送队列 + 独立发送协程。"""
+
+    def __init__(self, websocket: WebSocket) -> None:
+        self.websocket = websocket
+        # None 表示未发送过订阅消息，接收全部事件
+        self.topics: set[Topic] | None = None
+        self.pending: OrderedDict[Topic, _Frame] = OrderedDict()
+        self.wakeup = asyncio.Event()
+        self.sender: asyncio.Task | None = None
+
+    def wants(self, kind: str, task_id: int | None) -> bool:
+        if self.topics is None:
+            return True
+        return (kind, task_id) in self.topics or (kind, None) in self.topics
+
+    def enqueue(self, key: Topic, frame: _Frame) -> bool:
+        """放入发送队列，返回是否合并掉了一条尚未发送的旧消息。"""
+        previous = self.pending.get(key)
+        if previous is None:
+            self.pending[key] = frame
+            self.wakeup.set()
+            return False
+        # 未发出的终态消息保留，不被迟到的 running 消息覆盖
+        if previous.terminal and not frame.terminal:
+            return True
+        self.pending[key] = frame
+        return True
+
 
 class ProgressHub:
-    def __init__(self) -> None:
-        self._connections: set[WebSocket] = set()
-        self._lock = asyncio.Lock()
+    """WebSocket 进度推送。
+
+    - 客户端可在 /ws/progress 上发送
+      {"action": "subscribe" | "unsubscribe", "topics": [{"kind": ..., "id": ...}]}
+      按任务类型或具体任务订阅；未订阅过的连接接收全部事件，非 JSON 文本（如 ping）忽略
+    - 每个连接有独立的发送协程与待发送队列，同一任务只保留最新一条消息；
+      broadcast 只负责入队，慢连接不会拖慢其他连接
+    - 每条事件只编码一次（安装 orjson 时使用 orjson），所有连接发送同一个文本帧
+    - 待发送任务数超过 PROGRESS_QUEUE_MAX 或一批消息发送超过 PROGRESS_SEND_TIMEOUT 的连接被断开
+    - 多进程部署时本进程事件经 backplane 转发给其他进程，其他进程的事件由 backplane 回调推送
+    """
+
+    def __init__(
+        self,
+        *,
+        queue_max: int = PROGRESS_QUEUE_MAX,
+        send_timeout: float = PROGRESS_SEND_TIMEOUT,
+        flush_interval: float = PROGRESS_FLUSH_INTERVAL,
+        backplane: Backplane | None = None,
+    ) -> None:
+        self._backplane = backplane or LocalBackplane()
+        self._subscribers: dict[WebSocket, _Subscriber] = {}
+        self._queue_max = queue_max
+        self._send_timeout = send_timeout
+        self._flush_interval = flush_interval
+        self._stats = {
+            "events": 0,
+            "remote_events": 0,
+            "encoded": 0,
+            "enqueued": 0,
+            "coalesced": 0,
+            "sent": 0,
+            "dropped": 0,
+        }
+
+    async def start(self) -> None:
+        await self._backplane.start(self._deliver_remote)
+
+    async def close(self) -> None:
+        await self._backplane.close()
 
     async def connect(self, websocket: WebSocket) -> None:
         await websocket.accept()
-        async with self._lock:
-            self._connections.add(websocket)
+        sub = _Subscriber(websocket)
+        sub.sender = asyncio.create_task(self._send_loop(sub), name="progress-sender")
+        self._subscribers[websocket] = sub
 
     async def disconnect(self, websocket: WebSocket) -> None:
-        async with self._lock:
-            self._connections.discard(websocket)
+        sub = self._subscribers.pop(websocket, None)
+        if sub is not None and sub.sender is not None and sub.sender is not asyncio.current_task():
+            sub.sender.cancel()
+
+    async def handle_message(self, websocket: WebSocket, text: str) -> None:
+        """处理客户端发来的订阅 / 退订消息。"""
+        sub = self._subscribers.get(websocket)
+        if sub is None:
+            return
+        try:
+            message = json.loads(text)
+        except ValueError:
+            return
+        if not isinstance(message, dict):
+            return
+        action = message.get("action")
+        topics = _parse_topics(message.get("topics"))
+        if action == "subscribe":
+            sub.topics = (sub.topics or set()) | topics
+        elif action == "unsubscribe" and sub.topics is not None:
+            sub.topics -= topics
 
     async def broadcast(self, payload: dict) -> None:
-        async with self._lock:
-            sockets = list(self._connections)
-
-        stale: list[WebSocket] = []
-        for ws in sockets:
-            try:
-                await ws.send_json(payload)
-            except Exception:
-                stale.append(ws)
-
-        if stale:
-            async with self._lock:
-                for ws in stale:
-                    self._connections.discard(ws)
+        """推送本进程产生的事件：本地连接直接入队，并经 backplane 发往其他进程。"""
+        self._stats["events"] += 1
+        text = await self._fanout(payload, None)
+        if self._backplane.remote:
+            await self._backplane.publish(payload, text or encode_payload(payload))
+
+    async def _deliver_remote(self, payload: dict, text: str) -> None:
+        self._stats["remote_events"] += 1
+        await self._fanout(payload, text)
+
+    async def _fanout(self, payload: dict, text: str | None) -> str | None:
+        """把事件放入各订阅连接的发送队列，返回编码后的文本（未编码时为 text）。"""
+        kind = payload.get("kind", "")
+        task_id = payload.get("id")
+        key = (kind, task_id)
+
+        # 只在有订阅者时编码，且每条事件只编码一次
+        frame: _Frame | None = None
+        slow: list[_Subscriber] = []
+        for sub in list(self._subscribers.values()):
+            if not sub.wants(kind, task_id):
+                continue
+            if frame is None:
+                if text is None:
+                    text = encode_payload(payload)
+                    self._stats["encoded"] += 1
+                frame = _Frame(text, payload.get("status") in _TERMINAL_STATUSES)
+            if sub.enqueue(key, frame):
+                self._stats["coalesced"] += 1
+            else:
+                self._stats["enqueued"] += 1
+                if len(sub.pending) > self._queue_max:
+                    slow.append(sub)
+
+        for sub in slow:
+            await self._drop(sub, "send queue overflow")
+        return text
+
+    async def _send_loop(self, sub: _Subscriber) -> None:
+        ws = sub.websocket
+        try:
+            while True:
+                await sub.wakeup.wait()
+                if self._flush_interval > 0:
+                    await asyncio.sleep(self._flush_interval)
+                sub.wakeup.clear()
+                await asyncio.wait_for(self._drain(sub), self._send_timeout)
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            await self._drop(sub, "send timeout")
+        except Exception:
+            await self.disconnect(ws)
+
+    async def _drain(self, sub: _Subscriber) -> None:
+        """发送队列中的全部消息（超时按整批计算）。"""
+        while sub.pending:
+            _, frame = sub.pending.popitem(last=False)
+            await sub.websocket.send_text(frame.text)
+            self._stats["sent"] += 1
+
+    async def _drop(self, sub: _Subscriber, reason: str) -> None:
+        if self._subscribers.get(sub.websocket) is not sub:
+            return
+        self._stats["dropped"] += 1
+        logger.warning("断开慢速进度订阅连接: %s", reason)
+        await self.disconnect(sub.websocket)
+        try:
+            await asyncio.wait_for(sub.websocket.close(code=1013, reason=reason), 1.0)
+        except Exception:
+            pass
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "connections": len(self._subscribers),
+            "pending": sum(len(sub.pending) for sub in self._subscribers.values()),
+            **self._stats,
+            "backplane": self._backplane.stats(),
+        }
+
+
+class ProgressSink:
+    """单个任务的进度出口：推送到 ProgressHub 并写回数据库，按时间和变化量节流。
+
+    update() 只有在距上次发送超过 min_interval 秒、或进度变化达到 min_delta 时
+    才真正发送；数据库写入经 CoalescingWriter 合并。所有任务的 progress 统一为
+    0~100 的百分比，推送和写库使用同一个值；model 为 None 时只推送不写库
+    （如批量抠图的汇总进度，各行的进度由 worker 单独写入）。
+    """
+
+    def __init__(
+        self,
+        hub: ProgressHub,
+        writer: CoalescingWriter,
+        *,
+        kind: str,
+        task_id: int,
+        model: type | None,
+        min_interval: float = PROGRESS_MIN_INTERVAL,
+        min_delta: float = 1.0,
+    ) -> None:
+        self._hub = hub
+        self._writer = writer
+        self._kind = kind
+        self._task_id = task_id
+        self._model = model
+        self._min_interval = min_interval
+        self._min_delta = min_delta
+        self._last_progress: float | None = None
+        self._last_sent = 0.0
+
+    async def update(self, progress: float, *, force: bool = False, **fields: Any) -> bool:
+        """推送 running 状态进度，返回是否实际发送。"""
+        now = time.monotonic()
+        if not force and self._last_progress is not None:
+            if progress == self._last_progress:
+                return False
+            if (
+                now - self._last_sent < self._min_interval
+                and abs(progress - self._last_progress) < self._min_delta
+            ):
+                return False
+        self._last_progress = progress
+        self._last_sent = now
+
+        if self._model is not None:
+            self._writer.update(self._model, self._task_id, progress=progress)
+        await self._hub.broadcast({
+            "kind": self._kind,
+            "id": self._task_id,
+            "status": "running",
+            "progress": progress,
+            **fields,
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+        })
+        return True
@@ -0,0 +1,267 @@
+"""Generation result cache — 相同工作流直接复用已渲染的图片。
+
+固定 seed 的生成任务完全由工作流决定：提示词（含触发词）、LoRA、ControlNet 配置、
+seed，以及按内容哈希命名的输入图都已写在 build_flux_workflow 的输出中。
+以规范化工作流的哈希为键缓存渲染结果，命中时直接硬链接到 outputs/，不再占用 GPU。
+
+- 每个条目是 RESULT_CACHE_DIR/<key>/ 下按帧序号命名的 PNG
+- 按总大小（RESULT_CACHE_MB）做 LRU 淘汰，超过 RESULT_CACHE_MAX_AGE_DAYS 未使用的条目删除
+- stats() 暴露命中 / 未命中 / 写入 / 淘汰计数
+
+同一实现也用作 ControlNet 预处理图缓存（control_map_cache）：键为
+(控制图内容哈希, 控制类型, 预处理参数)，预览接口与生成任务共用。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+from app import fileio
+from app.file_store import PROJECT_ROOT
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE", "1") != "0"
+RESULT_CACHE_DIR = Path(os.getenv("RESULT_CACHE_DIR", str(PROJECT_ROOT / "cache" / "results")))
+RESULT_CACHE_MB = int(os.getenv("RESULT_CACHE_MB", "2048"))
+RESULT_CACHE_MAX_AGE_DAYS = float(os.getenv("RESULT_CACHE_MAX_AGE_DAYS", "30"))
+
+CONTROLNET_CACHE_ENABLED = os.getenv("CONTROLNET_CACHE", "1") != "0"
+CONTROLNET_CACHE_DIR = Path(os.getenv("CONTROLNET_CACHE_DIR", str(PROJECT_ROOT / "cache" / "controlnet")))
+CONTROLNET_CACHE_MB = int(os.getenv("CONTROLNET_CACHE_MB", "512"))
+
+# 工作流结构或保存格式变化时递增，使旧条目失效
+_FINGERPRINT_VERSION = 1
+
+
+def workflow_fingerprint(workflow: dict, **extra: Any) -> str:
+    """工作流的规范化哈希；extra 用于加入工作流之外的内容版本（如 LoRA 文件的 mtime）。"""
+    canonical = json.dumps(
+        {"v": _FINGERPRINT_VERSION, "workflow": workflow, "extra": extra},
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def control_map_key(image_name: str, control_type: str, params: dict[str, Any]) -> str:
+    """ControlNet 预处理图的缓存键；image_name 是按内容哈希命名的控制图文件名。"""
+    return workflow_fingerprint(
+        {"image": image_name, "type": control_type, "params": params},
+        kind="controlnet",
+    )
+
+
+@dataclass
+class _Entry:
+    count: int
+    size: int
+    last_used: float
+
+
+class ResultCache:
+    """磁盘上的渲染结果缓存，索引保存在内存中，首次使用时扫描目录重建。"""
+
+    def __init__(
+        self,
+        root: Path = RESULT_CACHE_DIR,
+        *,
+        max_bytes: int = RESULT_CACHE_MB * 1024 * 1024,
+        max_age: float = RESULT_CACHE_MAX_AGE_DAYS * 86400,
+        enabled: bool = RESULT_CACHE_ENABLED,
+    ) -> None:
+        self.root = root
+        self.enabled = enabled
+        self._max_bytes = max_bytes
+        self._max_age = max_age
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._bytes = 0
+        self._loaded = False
+        # 冷启动时并发的 lookup / put 共用一次扫描，都要等索引重建完成
+        self._load_lock = asyncio.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+
+    # ---------------- 索引 ----------------
+
+    def _scan(self) -> list[tuple[str, _Entry]]:
+        if not self.root.exists():
+            return []
+        entries: list[tuple[str, _Entry]] = []
+        for path in self.root.iterdir():
+            if not path.is_dir() or path.name.startswith("."):
+                continue
+            files = list(path.glob("*.png"))
+            if not files:
+                continue
+            size = sum(f.stat().st_size for f in files)
+            entries.append((path.name, _Entry(len(files), size, path.stat().st_mtime)))
+        entries.sort(key=lambda item: item[1].last_used)
+        return entries
+
+    async def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if self._loaded:
+                return
+            for key, entry in await fileio.run(self._scan):
+                if key not in self._entries:
+                    self._entries[key] = entry
+                    self._bytes += entry.size
+            self._loaded = True
+            await self._evict()
+
+    # ---------------- 读写 ----------------
+
+    async def lookup(self, key: str, count: int) -> list[Path] | None:
+        """命中且帧数一致时返回缓存中的 count 个文件路径（并刷新 LRU），否则返回 None。"""
+        if not self.enabled:
+            return None
+        await self._ensure_loaded()
+        entry = self._entries.get(key)
+        if entry is None or entry.count != count or time.time() - entry.last_used > self._max_age:
+            self._stats["misses"] += 1
+            return None
+
+        entry_dir = self.root / key
+        try:
+            await fileio.run(os.utime, entry_dir)
+        except OSError as exc:
+            # 缓存目录被外部删除等情况：丢弃条目，按未命中处理
+            logger.warning("结果缓存条目 %s 不可用: %s", key, exc)
+            await self._remove(key)
+            self._stats["misses"] += 1
+            return None
+
+        entry.last_used = time.time()
+        self._entries.move_to_end(key)
+        self._stats["hits"] += 1
+        return [entry_dir / f"{i}.png" for i in range(count)]
+
+    async def get(self, key: str, count: int, dests: list[Path]) -> bool:
+        """命中且帧数一致时把缓存的 count 张图片链接到 dests，返回是否命中。"""
+        files = await self.lookup(key, count)
+        if files is None:
+            return False
+        try:
+            for src, dest in zip(files, dests):
+                await fileio.run(_replace_with_link, src, dest)
+        except OSError as exc:
+            logger.warning("结果缓存条目 %s 不可用: %s", key, exc)
+            await self._remove(key)
+            self._stats["hits"] -= 1
+            self._stats["misses"] += 1
+            return False
+        return True
+
+    async def put(self, key: str, files: list[Path]) -> None:
+        """把一次渲染的结果（按帧顺序）存入缓存。"""
+        if not self.enabled:
+            return
+        await self._ensure_loaded()
+        if key in self._entries:
+            return
+        try:
+            count, size, stored = await fileio.run(_store_entry, self.root, key, files)
+        except OSError as exc:
+            logger.warning("写入结果缓存失败: %s", exc)
+            return
+        if key in self._entries:
+            return
+        self._entries[key] = _Entry(count, size, time.time())
+        self._bytes += size
+        if stored:
+            self._stats["stores"] += 1
+        await self._evict()
+
+    async def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+        await fileio.run(shutil.rmtree, self.root / key, True)
+
+    async def _evict(self) -> None:
+        """删除过期条目，再按最久未用淘汰到总大小上限以内。"""
+        cutoff = time.time() - self._max_age
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.last_used < cutoff:
+                await self._remove(key)
+                self._stats["expired"] += 1
+            elif self._bytes > self._max_bytes:
+                await self._remove(key)
+                self._stats["evictions"] += 1
+            else:
+                break
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self._max_bytes,
+            "hit_rate": round(self._stats["hits"] / lookups, 3) if lookups else 0.0,
+            **self._stats,
+        }
+
+
+def _link_or_copy(src: Path, dest: Path) -> None:
+    """硬链接，跨文件系统时复制（不用符号链接：条目被淘汰后链接会失效）。"""
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+
+def _replace_with_link(src: Path, dest: Path) -> None:
+    if dest.exists():
+        dest.unlink()
+    _link_or_copy(src, dest)
+
+
+def _store_entry(root: Path, key: str, files: list[Path]) -> tuple[int, int, bool]:
+    """在临时目录中链接全部帧后整体重命名为 <key>，返回 (帧数, 总字节数, 是否新写入)。
+
+    <key> 已存在（其他任务或进程先写入了同一结果）时保留已有条目，返回它的帧数和大小。
+    """
+    dest = root / key
+    tmp = root / f".{key}.{uuid.uuid4().hex[:8]}"
+    tmp.mkdir(parents=True)
+    try:
+        for i, src in enumerate(files):
+            _link_or_copy(src, tmp / f"{i}.png")
+        size = sum(f.stat().st_size for f in tmp.iterdir())
+        try:
+            os.replace(tmp, dest)
+        except OSError:
+            if not dest.is_dir():
+                raise
+            existing = list(dest.glob("*.png"))
+            shutil.rmtree(tmp, ignore_errors=True)
+            return len(existing), sum(f.stat().st_size for f in existing), False
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return len(files), size, True
+
+
+# 进程级共享缓存
+result_cache = ResultCache()
+control_map_cache = ResultCache(
+    CONTROLNET_CACHE_DIR,
+    max_bytes=CONTROLNET_CACHE_MB * 1024 * 1024,
+    enabled=CONTROLNET_CACHE_ENABLED,
+)
@@ -0,0 +1,365 @@
+"""Task scheduler — bounded-concurrency job queue for background tasks.
+
+每种任务类型（generation / remove_bg / training / preview）拥有独立的
+worker 池与并发上限，替代无上限的 asyncio.create_task：
+- 持久化任务以任务表中 status=queued 的行为准，重启后重新入队
+- preview 等同步请求可通过 run() 在对应池内执行并等待结果
+- 提交时可带分组（如抠图模型）：队列优先取出与上一个任务同组的任务，
+  让 ComfyUI 保持同一模型常驻，而不是在模型之间来回切换
+- stats() 暴露队列深度、运行数、排队等待时间与分组切换次数
+- 多进程部署时只有持有调度锁（SchedulerLock）的进程执行持久化任务，
+  其他进程的 submit() 只把任务留在数据库中（status=queued），由持锁进程接手
+
+各 worker 池之间共享一个按优先级出让的 GPU 闸门（gpu_gate）：
+交互式预览 > 抠图 > 批量生成 > 训练；同优先级内按任务轮转分配，
+多个生成任务的帧交替执行，而不是一个任务跑完全部帧才轮到下一个。
+"""
+
+from __future__ import annotations
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator, Awaitable, Callable, Hashable
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, TypeVar
+
+from app.comfyui_client import COMFYUI_URLS
+from app.file_store import PROJECT_ROOT
+
+try:  # fcntl 仅 POSIX 可用；没有时视为单进程部署
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# 各任务类型的 worker 数（并发上限）
+DEFAULT_CONCURRENCY: dict[str, int] = {
+    "generation": int(os.getenv("SCHED_GENERATION_CONCURRENCY", "2")),
+    "remove_bg": int(os.getenv("SCHED_REMOVE_BG_CONCURRENCY", "2")),
+    "training": int(os.getenv("SCHED_TRAINING_CONCURRENCY", "1")),
+    "preview": int(os.getenv("SCHED_PREVIEW_CONCURRENCY", "2")),
+}
+
+# 等待时间统计窗口（最近 N 个任务）
+_WAIT_WINDOW = 256
+
+# 优先级（数值越小越先获得 GPU）
+PRIORITY: dict[str, int] = {
+    "preview": 0,
+    "remove_bg": 1,
+    "generation": 2,
+    "training": 3,
+}
+
+# 每个 ComfyUI 后端同时提交的 prompt 数（>1 时其队列中始终有下一个 prompt 待执行）；
+# 闸门是全局的，总槽位按后端数放大，配置多个 COMFYUI_URLS 时每个实例都能分到 prompt
+GPU_SLOTS_PER_BACKEND = int(os.getenv("SCHED_GPU_SLOTS", "2"))
+GPU_SLOTS = max(GPU_SLOTS_PER_BACKEND, 1) * max(len(COMFYUI_URLS), 1)
+
+# 多个 API 进程之间选出唯一调度进程的锁文件；默认放在项目根目录，
+# 与各进程的工作目录无关，保证所有 worker 竞争的是同一把锁
+SCHEDULER_LOCK_PATH = os.getenv("SCHEDULER_LOCK_PATH", str(PROJECT_ROOT / "scheduler.lock"))
+
+# 同组任务连续优先出队的上限，达到后按 FIFO 取最早的任务，避免其他组饿死
+SCHED_GROUP_MAX_STREAK = int(os.getenv("SCHED_GROUP_MAX_STREAK", "16"))
+
+# 记录最近获得 GPU 的 owner 数量上限（用于同优先级轮转）
+_FAIRNESS_OWNERS_MAX = 4096
+
+
+@dataclass
+class _Job:
+    kind: str
+    key: Any
+    enqueued_at: float = field(default_factory=time.monotonic)
+    run: Callable[[], Awaitable[Any]] | None = None
+    future: asyncio.Future | None = None
+    group: Hashable = None
+
+
+class _GroupingQueue(asyncio.Queue):
+    """FIFO 队列，但优先取出与上一个出队任务同组的任务。
+
+    连续同组出队达到 max_streak 次后取队首（最早入队）的任务；
+    未分组（group=None）的任务不影响当前组。
+    """
+
+    def __init__(self, max_streak: int = SCHED_GROUP_MAX_STREAK) -> None:
+        self._max_streak = max(max_streak, 1)
+        super().__init__()
+
+    def _init(self, maxsize: int) -> None:
+        self._queue: deque[_Job] = deque()
+        self._group: Hashable = None
+        self._streak = 0
+        self.switches = 0
+
+    def _put(self, item: _Job) -> None:
+        self._queue.append(item)
+
+    def _get(self) -> _Job:
+        item = self._queue[0]
+        if self._group is not None and item.group != self._group and self._streak < self._max_streak:
+            for candidate in self._queue:
+                if candidate.group == self._group:
+                    item = candidate
+                    break
+        self._queue.remove(item)
+
+        if item.group is not None:
+            if item.group == self._group:
+                self._streak += 1
+            else:
+                if self._group is not None:
+                    self.switches += 1
+                self._group = item.group
+                self._streak = 1
+        return item
+
+
+@dataclass
+class _KindStats:
+    running: int = 0
+    completed: int = 0
+    failed: int = 0
+    waits: deque[float] = field(default_factory=lambda: deque(maxlen=_WAIT_WINDOW))
+
+
+class SchedulerLock:
+    """进程间互斥的调度锁（非阻塞 flock），进程退出时由操作系统自动释放。"""
+
+    def __init__(self, path: str = SCHEDULER_LOCK_PATH) -> None:
+        self._path = path
+        self._fd: int | None = None
+
+    @property
+    def held(self) -> bool:
+        return self._fd is not None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        if fcntl is None:
+            self._fd = -1
+            return True
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        if self._fd is None:
+            return
+        if self._fd >= 0:
+            os.close(self._fd)
+        self._fd = None
+
+
+class TaskScheduler:
+    """按任务类型划分 worker 池的有界并发调度器。
+
+    dispatching=False 时 submit() 不入队（任务留在数据库中等待调度进程接手），
+    run() 提交的同步任务（如预览）仍在本进程执行。
+    """
+
+    def __init__(
+        self,
+        concurrency: dict[str, int] | None = None,
+        *,
+        dispatching: bool = True,
+    ) -> None:
+        self.dispatching = dispatching
+        self._concurrency = dict(concurrency or DEFAULT_CONCURRENCY)
+        self._queues: dict[str, _GroupingQueue] = {
+            kind: _GroupingQueue() for kind in self._concurrency
+        }
+        self._handlers: dict[str, Callable[[Any], Awaitable[None]]] = {}
+        self._stats: dict[str, _KindStats] = {kind: _KindStats() for kind in self._concurrency}
+        self._active: set[tuple[str, Any]] = set()
+        self._workers: list[asyncio.Task] = []
+
+    def register(self, kind: str, handler: Callable[[Any], Awaitable[None]]) -> None:
+        """注册持久化任务的处理函数，handler 接收任务 id。"""
+        if kind not in self._queues:
+            raise ValueError(f"unknown task kind: {kind}")
+        self._handlers[kind] = handler
+
+    async def start(self) -> None:
+        if self._workers:
+            return
+        for kind, size in self._concurrency.items():
+            for n in range(max(size, 1)):
+                self._workers.append(
+                    asyncio.create_task(self._worker(kind), name=f"scheduler-{kind}-{n}")
+                )
+        logger.info("调度器已启动: %s", self._concurrency)
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    def submit(self, kind: str, key: Any, *, group: Hashable = None) -> bool:
+        """提交一个持久化任务；同一任务已在队列或执行中时忽略，返回是否入队。
+
+        group 相同的任务尽量连续执行（如同一抠图模型）。
+        """
+        if not self.dispatching or (kind, key) in self._active:
+            return False
+        self._active.add((kind, key))
+        self._queues[kind].put_nowait(_Job(kind=kind, key=key, group=group))
+        return True
+
+    async def run(self, kind: str, fn: Callable[[], Awaitable[T]]) -> T:
+        """在 kind 对应的 worker 池内执行 fn 并等待其结果（用于同步接口）。"""
+        future: asyncio.Future[T] = asyncio.get_running_loop().create_future()
+        self._queues[kind].put_nowait(_Job(kind=kind, key=None, run=fn, future=future))
+        return await future
+
+    async def _worker(self, kind: str) -> None:
+        queue = self._queues[kind]
+        stats = self._stats[kind]
+        while True:
+            job = await queue.get()
+            stats.waits.append(time.monotonic() - job.enqueued_at)
+            stats.running += 1
+            try:
+                if job.run is not None:
+                    result = await job.run()
+                    if job.future is not None and not job.future.done():
+                        job.future.set_result(result)
+                else:
+                    await self._handlers[kind](job.key)
+                stats.completed += 1
+            except asyncio.CancelledError:
+                if job.future is not None and not job.future.done():
+                    job.future.cancel()
+                raise
+            except Exception as exc:
+                stats.failed += 1
+                if job.future is not None and not job.future.done():
+                    job.future.set_exception(exc)
+                else:
+                    logger.exception("调度任务失败: %s #%s", kind, job.key)
+            finally:
+                stats.running -= 1
+                self._active.discard((kind, job.key))
+                queue.task_done()
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        """各任务类型的队列深度、运行数与等待时间（秒）。"""
+        result: dict[str, dict[str, Any]] = {}
+        for kind, stats in self._stats.items():
+            waits = sorted(stats.waits)
+            result[kind] = {
+                "concurrency": self._concurrency[kind],
+                "queued": self._queues[kind].qsize(),
+                "running": stats.running,
+                "completed": stats.completed,
+                "failed": stats.failed,
+                "wait_avg": round(sum(waits) / len(waits), 3) if waits else 0.0,
+                "wait_p95": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0.0,
+                "wait_max": round(waits[-1], 3) if waits else 0.0,
+                "group_switches": self._queues[kind].switches,
+            }
+        return result
+
+
+# ---------------------------------------------------------------------------
+#  GPU 闸门 — 优先级 + 同级轮转
+# ---------------------------------------------------------------------------
+
+
+class PriorityGate:
+    """按优先级出让的 GPU 槽位。
+
+    等待者按 (优先级, owner 上次获得槽位的序号, 到达序号) 排序：
+    高优先级先行；同优先级下最久未被服务的 owner（通常是一个任务）先行，
+    从而在并发生成任务之间逐帧轮转。
+    """
+
+    def __init__(self, slots: int = GPU_SLOTS) -> None:
+        self._slots = max(slots, 1)
+        self._in_use = 0
+        self._waiters: list[tuple[int, int, int, Hashable, asyncio.Future[None]]] = []
+        self._seq = itertools.count()
+        self._grants = 0
+        self._last_grant: OrderedDict[Hashable, int] = OrderedDict()
+        self._waiting_by_kind: dict[str, int] = {}
+
+    @asynccontextmanager
+    async def slot(self, kind: str, owner: Hashable = None) -> AsyncIterator[None]:
+        await self.acquire(kind, owner)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, kind: str, owner: Hashable = None) -> None:
+        if self._in_use < self._slots and not self._waiters:
+            self._grant(owner)
+            return
+
+        future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+        entry = (
+            PRIORITY.get(kind, len(PRIORITY)),
+            self._last_grant.get(owner, 0),
+            next(self._seq),
+            owner,
+            future,
+        )
+        heapq.heappush(self._waiters, entry)
+        self._waiting_by_kind[kind] = self._waiting_by_kind.get(kind, 0) + 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            # 已分配到槽位但调用方被取消：归还槽位
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            self._waiting_by_kind[kind] -= 1
+
+    def release(self) -> None:
+        self._in_use -= 1
+        while self._in_use < self._slots and self._waiters:
+            *_, owner, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self._grant(owner)
+            future.set_result(None)
+
+    def _grant(self, owner: Hashable) -> None:
+        self._in_use += 1
+        self._grants += 1
+        if owner is not None:
+            self._last_grant[owner] = self._grants
+            self._last_grant.move_to_end(owner)
+            while len(self._last_grant) > _FAIRNESS_OWNERS_MAX:
+                self._last_grant.popitem(last=False)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "slots": self._slots,
+            "in_use": self._in_use,
+            "grants": self._grants,
+            "waiting": {k: v for k, v in self._waiting_by_kind.items() if v},
+        }
+
+
+# 进程级共享 GPU 闸门
+gpu_gate = PriorityGate()
@@ -4,6 +4,11 @@ from typing import Any, Literal
 from pydantic import BaseModel, Field
 
 
+# 所有任务（训练 / 生成 / 抠图）的 progress 统一为 0~100 的百分比，
+# REST 返回值与 /ws/progress 推送的 progress、frame_progress 单位一致
+PROGRESS_DESCRIPTION = "进度百分比（0~100），与 WebSocket 推送的单位一致"
+
+
 # ---------- ControlNet ----------
 
 
@@ -67,7 +72,7 @@ class TrainingJobRead(BaseModel):
     dataset_path: str
     status: str
     params: dict[str, Any]
-    progress: float
+    progress: float = Field(description=PROGRESS_DESCRIPTION)
     output_lora_path: str | None
     created_at: datetime
 
@@ -84,6 +89,7 @@ class GenerationTaskCreate(BaseModel):
     seed: int | None = None
     batch_size: int = Field(default=1, ge=1, le=32)
     controlnet: ControlNetConfig | None = None
+    remove_background: bool = False
 
 
 class GenerationTaskRead(BaseModel):
@@ -96,7 +102,9 @@ class GenerationTaskRead(BaseModel):
     seed: int | None
     batch_size: int
     controlnet_config: dict | None
+    remove_background: bool = False
     status: str
+    progress: float = Field(default=0.0, description=PROGRESS_DESCRIPTION)
     output_paths: list[str]
     created_at: datetime
 
@@ -109,7 +117,7 @@ class TaskListItem(BaseModel):
     task_kind: Literal["training", "generation", "remove_bg"]
     status: str
     created_at: datetime
-    progress: float | None = None
+    progress: float | None = Field(default=None, description=PROGRESS_DESCRIPTION)
     output_paths: list[str] | None = None
 
 
@@ -117,8 +125,9 @@ class TaskListItem(BaseModel):
 
 
 class BackgroundRemovalCreate(BaseModel):
+    """model=auto 时按图片尺寸选择：小图用 birefnet，长边超过 REMOVE_BG_AUTO_HR_SIDE 用 birefnet-hr。"""
     input_image: str
-    model: Literal["birefnet", "birefnet-hr"] = "birefnet"
+    model: Literal["auto", "birefnet", "birefnet-hr"] = "auto"
     source_task_id: int | None = None
 
 
@@ -128,9 +137,26 @@ class BackgroundRemovalRead(BaseModel):
     output_image: str | None
     model: str
     status: str
+    progress: float = Field(default=0.0, description=PROGRESS_DESCRIPTION)
     source_task_id: int | None
+    batch_id: int | None = None
     created_at: datetime
     completed_at: datetime | None
 
     class Config:
         from_attributes = True
+
+
+class BackgroundRemovalBatchCreate(BaseModel):
+    """批量抠图：给出 input_images，或只给 source_task_id 表示该生成任务的全部输出。"""
+    input_images: list[str] = Field(default_factory=list, max_length=256)
+    model: Literal["auto", "birefnet", "birefnet-hr"] = "auto"
+    source_task_id: int | None = None
+
+
+class BackgroundRemovalBatchRead(BaseModel):
+    batch_id: int
+    status: str
+    progress: float = Field(default=0.0, description="批次内各任务进度的平均值（0~100）")
+    source_task_id: int | None
+    tasks: list[BackgroundRemovalRead]
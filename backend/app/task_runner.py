@@ -2,10 +2,13 @@
 
 支持：
 - Flux.1 Schnell 生成（txt2img / img2img）
-- 批量变体生成（batch_size > 1 时循环执行，每帧随机 seed）
+- 批量变体生成（batch_size > 1 时按 chunk 以 latent batch 渲染，失败回退逐帧）
+- 生成后串接抠图（同一 prompt 内保存原图与透明图，自动关联抠图任务）
+- GPU 按优先级逐帧分配（预览 > 抠图 > 批量生成 > 训练）
+- 流水线提交（多个 prompt 同时排队，结果收集与渲染并行）
 - 单帧重试（最多 3 次）
 - partial 状态（部分帧成功）
-- BiRefNet 背景移除
+- BiRefNet 背景移除（单张，或批量分块：一个 prompt 处理多张图片）
 - MFlux LoRA 训练
 """
 
@@ -15,103 +18,271 @@ import asyncio
 import logging
 import os
 import random
-import shutil
-import uuid
+import time
+from collections import deque
 from datetime import datetime, timezone
 from pathlib import Path
+from typing import Any
 
-import aiohttp
-from sqlalchemy import select
+from sqlalchemy import func, select, update
 from sqlalchemy.ext.asyncio import async_sessionmaker
 
+from app import fileio
 from app.comfyui_client import (
-    COMFYUI_URL,
+    DEFAULT_REMOVE_BG_MODEL,
     build_flux_workflow,
+    build_remove_bg_batch_workflow,
     build_remove_bg_workflow,
-    extract_image_paths,
+    controlnet_preprocess_params,
+    extract_error,
+    output_images,
     queue_prompt,
+    remove_bg_batch_outputs,
+    save_output_image,
+    split_flux_outputs,
+    stage_input_image,
     wait_for_completion,
 )
+from app.database import status_writer
+from app.file_store import PROJECT_ROOT
+from app.gpu_memory import gpu_cache_policy
 from app.models import BackgroundRemovalTask, GenerationTask, Style, TrainingJob
-from app.progress import ProgressHub
+from app.progress import ProgressHub, ProgressSink
+from app.result_cache import (
+    control_map_cache,
+    control_map_key,
+    result_cache,
+    workflow_fingerprint,
+)
+from app.scheduler import SchedulerLock, TaskScheduler, gpu_gate
 
 logger = logging.getLogger(__name__)
 
 # Where we copy finished images so the backend can serve them
-OUTPUT_DIR = Path(__file__).resolve().parent.parent.parent / "outputs"
+OUTPUT_DIR = PROJECT_ROOT / "outputs"
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
+# 训练产出的 LoRA 放入 ComfyUI 的 loras 目录
+COMFYUI_LORA_DIR = PROJECT_ROOT / "ComfyUI" / "models" / "loras"
+
 # 单帧最大重试次数
 MAX_RETRIES = 3
 
+# 批量生成时单个 prompt 渲染的帧数，按显存调整；1 表示逐帧。
+# 未指定 seed 时 chunk 以 latent batch 渲染（各帧共用首帧 seed，噪声由 batch index 决定）；
+# 指定 seed 时 chunk 内每帧一条采样分支、使用各自的 seed+i，结果与分块方式无关
+GENERATION_CHUNK_SIZE = int(os.getenv("GENERATION_CHUNK_SIZE", "1"))
+
+# 单个生成任务同时在 ComfyUI 队列中的 prompt 数（流水线深度），1 表示串行
+GENERATION_PIPELINE_DEPTH = int(os.getenv("GENERATION_PIPELINE_DEPTH", "2"))
+
+# 批量抠图时单个 prompt 处理的图片数
+REMOVE_BG_CHUNK_SIZE = int(os.getenv("REMOVE_BG_CHUNK_SIZE", "8"))
+
+# 调度进程轮询数据库、接手其他 API 进程创建的任务的间隔（秒）
+SCHEDULER_POLL_INTERVAL = float(os.getenv("SCHEDULER_POLL_INTERVAL", "1.0"))
+
+# 抠图耗时统计窗口（每个模型最近 N 个 prompt）
+_LATENCY_WINDOW = 256
+
 
 def _ts() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
-async def _clear_gpu_cache() -> None:
-    """尝试通过 ComfyUI API 释放显存缓存。"""
+class ModelLatency:
+    """按模型统计抠图 prompt 的执行耗时（提交到完成，不含 GPU 闸门排队）。"""
+
+    def __init__(self, window: int = _LATENCY_WINDOW) -> None:
+        self._window = window
+        self._samples: dict[str, deque[tuple[float, int]]] = {}
+        self._totals: dict[str, list[int]] = {}
+
+    def record(self, model: str, seconds: float, images: int = 1) -> None:
+        self._samples.setdefault(model, deque(maxlen=self._window)).append((seconds, images))
+        totals = self._totals.setdefault(model, [0, 0])
+        totals[0] += 1
+        totals[1] += images
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        result: dict[str, dict[str, float]] = {}
+        for model, samples in self._samples.items():
+            durations = sorted(d for d, _ in samples)
+            images = sum(n for _, n in samples)
+            prompts, total_images = self._totals[model]
+            result[model] = {
+                "prompts": prompts,
+                "images": total_images,
+                "avg": round(sum(durations) / len(durations), 3),
+                "p95": round(durations[min(len(durations) - 1, int(len(durations) * 0.95))], 3),
+                "max": round(durations[-1], 3),
+                "per_image_avg": round(sum(durations) / images, 3) if images else 0.0,
+            }
+        return result
+
+
+# 进程级抠图耗时统计（/api/metrics 的 remove_bg_models）
+remove_bg_latency = ModelLatency()
+
+
+def _file_version(path: Path) -> tuple[int, int] | None:
+    """文件的 (size, mtime_ns)，不存在时返回 None。"""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{COMFYUI_URL}/free",
-                json={"unload_models": False, "free_memory": True},
-                timeout=aiohttp.ClientTimeout(total=10),
-            ) as resp:
-                if resp.status == 200:
-                    logger.debug("GPU 缓存已清理")
-    except Exception:
-        pass
+        st = path.stat()
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
 
 
 # ---------------------------------------------------------------------------
-#  Public entry points (fire-and-forget async tasks)
+#  Public entry points (submitted to the bounded TaskScheduler)
 # ---------------------------------------------------------------------------
 
 
-def run_training_job(
+def register_workers(
+    scheduler: TaskScheduler,
     *,
     session_maker: async_sessionmaker,
     progress_hub: ProgressHub,
-    job_id: int,
 ) -> None:
-    asyncio.create_task(
-        _training_job_worker(
-            session_maker=session_maker,
-            progress_hub=progress_hub,
-            job_id=job_id,
-        )
+    """把各类 worker 注册到调度器。"""
+    scheduler.register(
+        "training",
+        lambda job_id: _training_job_worker(
+            session_maker=session_maker, progress_hub=progress_hub, job_id=job_id
+        ),
+    )
+    scheduler.register(
+        "generation",
+        lambda task_id: _generation_task_worker(
+            session_maker=session_maker, progress_hub=progress_hub, task_id=task_id
+        ),
+    )
+    scheduler.register(
+        "remove_bg",
+        lambda task_id: _remove_bg_worker(
+            session_maker=session_maker, progress_hub=progress_hub, task_id=task_id
+        ),
     )
 
 
-def run_generation_task(
+async def recover_queued_tasks(
+    scheduler: TaskScheduler,
     *,
     session_maker: async_sessionmaker,
-    progress_hub: ProgressHub,
-    task_id: int,
-) -> None:
-    asyncio.create_task(
-        _generation_task_worker(
-            session_maker=session_maker,
-            progress_hub=progress_hub,
-            task_id=task_id,
+    reset_running: bool = True,
+) -> int:
+    """把数据库中 queued 的任务入队，返回新入队的数量。
+
+    reset_running=True 时（成为调度进程时）running 行是上一个调度进程中断留下的，
+    先重置为 queued 再一起入队。调度进程每秒轮询一次，因此只查询入队所需的列
+    （键与分组），走 (status, created_at) 索引。已在队列或执行中的任务由调度器去重，
+    worker 执行前再用 _claim 认领，同一行不会被执行两次。
+    """
+    # (任务类型, 表, 调度键, 分组)；批量抠图按批次入队（batch_id 即批次首行 id），按模型分组
+    tables = [
+        (TrainingJob, "training", TrainingJob.id, None),
+        (GenerationTask, "generation", GenerationTask.id, None),
+        (
+            BackgroundRemovalTask,
+            "remove_bg",
+            func.coalesce(BackgroundRemovalTask.batch_id, BackgroundRemovalTask.id),
+            BackgroundRemovalTask.model,
+        ),
+    ]
+    submitted = 0
+    async with session_maker() as session:
+        if reset_running:
+            for model, *_ in tables:
+                await session.execute(
+                    update(model).where(model.status == "running").values(status="queued")
+                )
+            await session.commit()
+        for model, kind, key, group in tables:
+            columns = (key,) if group is None else (key, group)
+            result = await session.execute(
+                select(*columns).where(model.status == "queued").order_by(model.created_at)
+            )
+            count = 0
+            for row in result.all():
+                count += scheduler.submit(kind, row[0], group=row[1] if group is not None else None)
+            if count:
+                logger.info("已入队 %d 个 %s 任务", count, kind)
+            submitted += count
+    return submitted
+
+
+async def _claim(session_maker: async_sessionmaker, model: type, *conditions: Any) -> bool:
+    """把满足条件且仍为 queued 的行原子地改为 running，返回是否认领到。
+
+    调度器的去重只在单个进程内有效；worker 开始执行前用条件 UPDATE 认领，
+    行已被其他 worker 认领或已结束时直接跳过。
+    """
+    async with session_maker() as session:
+        result = await session.execute(
+            update(model)
+            .where(model.status == "queued", *conditions)
+            .values(status="running")
         )
-    )
+        await session.commit()
+    return result.rowcount > 0
 
 
-def run_remove_bg_task(
+async def dispatch_loop(
+    scheduler: TaskScheduler,
+    lock: SchedulerLock,
     *,
     session_maker: async_sessionmaker,
-    progress_hub: ProgressHub,
-    task_id: int,
+    interval: float = SCHEDULER_POLL_INTERVAL,
 ) -> None:
-    asyncio.create_task(
-        _remove_bg_worker(
-            session_maker=session_maker,
-            progress_hub=progress_hub,
-            task_id=task_id,
-        )
-    )
+    """多进程部署时选出唯一的调度进程。
+
+    取得 SchedulerLock 的进程打开 scheduler.dispatching、恢复中断的任务，
+    之后定期把其他进程创建的 queued 任务入队；未取得锁的进程持续重试，
+    调度进程退出后由其中一个接替。
+    """
+    while True:
+        try:
+            if not scheduler.dispatching:
+                if await asyncio.to_thread(lock.try_acquire):
+                    scheduler.dispatching = True
+                    logger.info("本进程成为任务调度进程 (pid=%d)", os.getpid())
+                    await recover_queued_tasks(scheduler, session_maker=session_maker)
+            else:
+                await recover_queued_tasks(
+                    scheduler, session_maker=session_maker, reset_running=False
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("任务调度轮询失败")
+        await asyncio.sleep(interval)
+
+
+def run_training_job(*, scheduler: TaskScheduler, job_id: int) -> None:
+    scheduler.submit("training", job_id)
+
+
+def run_generation_task(*, scheduler: TaskScheduler, task_id: int) -> None:
+    scheduler.submit("generation", task_id)
+
+
+def run_remove_bg_task(*, scheduler: TaskScheduler, task_id: int, model: str | None = None) -> None:
+    """提交抠图任务；批量抠图传入 batch_id，整个批次由一个 worker 处理。
+
+    同一模型的抠图任务在调度队列中按 model 分组，尽量连续执行。
+    """
+    scheduler.submit("remove_bg", task_id, group=model)
+
+
+def remove_bg_batch_status(statuses: list[str]) -> str:
+    """由批次内各行状态汇总批次状态。"""
+    if any(s in ("queued", "running") for s in statuses):
+        return "queued" if all(s == "queued" for s in statuses) else "running"
+    completed = sum(s == "completed" for s in statuses)
+    if completed == len(statuses):
+        return "completed"
+    return "partial" if completed else "failed"
 
 
 # ---------------------------------------------------------------------------
@@ -132,6 +303,8 @@ async def _training_job_worker(
     训练完成后自动将 LoRA 文件复制到 ComfyUI/models/loras/ 目录。
     """
     try:
+        if not await _claim(session_maker, TrainingJob, TrainingJob.id == job_id):
+            return
         async with session_maker() as session:
             result = await session.execute(
                 select(TrainingJob).where(TrainingJob.id == job_id)
@@ -139,8 +312,6 @@ async def _training_job_worker(
             job = result.scalar_one_or_none()
             if not job:
                 return
-            job.status = "running"
-            await session.commit()
 
             # 提取训练参数
             params = job.params or {}
@@ -149,7 +320,7 @@ async def _training_job_worker(
 
         # MFlux 训练输出目录
         output_dir = OUTPUT_DIR / f"training_{job_id}"
-        output_dir.mkdir(parents=True, exist_ok=True)
+        await fileio.mkdir(output_dir)
 
         lora_rank = params.get("lora_rank", 16)
         learning_rate = params.get("learning_rate", 1e-4)
@@ -166,8 +337,23 @@ async def _training_job_worker(
             "--steps", str(steps),
         ]
 
+        # 训练在独立进程中运行数小时，不长期占用 GPU 槽位；
+        # 仅在启动前按最低优先级排队，让已在等待的交互任务先执行
+        async with gpu_gate.slot("training", ("training", job_id)):
+            pass
+
         logger.info("启动 MFlux 训练: %s", " ".join(cmd))
 
+        # 进度按时间 / 变化量节流后同时推送并写回 TrainingJob.progress，
+        # 训练期间可通过 GET /api/training/{id} 查询
+        sink = ProgressSink(
+            progress_hub,
+            status_writer,
+            kind="training",
+            task_id=job_id,
+            model=TrainingJob,
+        )
+
         proc = await asyncio.create_subprocess_exec(
             *cmd,
             stdout=asyncio.subprocess.PIPE,
@@ -189,13 +375,7 @@ async def _training_job_worker(
                     current_step = int(parts[0].strip())
                     total_steps = int(parts[1].split()[0].strip())
                     progress = current_step / total_steps * 100
-                    await progress_hub.broadcast({
-                        "kind": "training",
-                        "id": job_id,
-                        "progress": round(progress, 1),
-                        "status": "running",
-                        "timestamp": _ts(),
-                    })
+                    await sink.update(round(progress, 1))
                 except (IndexError, ValueError):
                     pass
 
@@ -203,20 +383,21 @@ async def _training_job_worker(
 
         if proc.returncode == 0:
             # 查找输出的 LoRA 文件
-            lora_files = list(output_dir.glob("*.safetensors"))
+            lora_files = await fileio.glob(output_dir, "*.safetensors")
             output_lora_path: str | None = None
 
             if lora_files:
                 # 复制到 ComfyUI/models/loras/
-                comfyui_loras = Path(__file__).resolve().parent.parent.parent / "ComfyUI" / "models" / "loras"
-                comfyui_loras.mkdir(parents=True, exist_ok=True)
+                await fileio.mkdir(COMFYUI_LORA_DIR)
                 lora_file = lora_files[0]
                 dest_name = f"trained_style_{style_id}.safetensors"
-                dest = comfyui_loras / dest_name
-                shutil.copy2(str(lora_file), str(dest))
+                dest = COMFYUI_LORA_DIR / dest_name
+                await fileio.copy_file(lora_file, dest)
                 output_lora_path = dest_name
                 logger.info("LoRA 已复制到: %s", dest)
 
+            # 先写出节流中的进度，避免稍后刷新覆盖下面的 progress=100
+            await status_writer.flush()
             async with session_maker() as session:
                 result = await session.execute(
                     select(TrainingJob).where(TrainingJob.id == job_id)
@@ -278,7 +459,9 @@ async def _generation_task_worker(
     task_id: int,
 ) -> None:
     try:
-        # ---- 1. 加载任务 & 可选风格 ----
+        # ---- 1. 认领并加载任务 & 可选风格 ----
+        if not await _claim(session_maker, GenerationTask, GenerationTask.id == task_id):
+            return
         async with session_maker() as session:
             result = await session.execute(
                 select(GenerationTask).where(GenerationTask.id == task_id)
@@ -299,9 +482,6 @@ async def _generation_task_worker(
                     lora_name = style.lora_path or None
                     trigger_words = style.trigger_words or ""
 
-            task.status = "running"
-            await session.commit()
-
             # 提取任务参数
             task_type = task.type
             task_prompt = task.prompt
@@ -310,129 +490,222 @@ async def _generation_task_worker(
             task_seed = task.seed
             task_batch_size = task.batch_size or 1
             task_controlnet_config = task.controlnet_config
+            task_remove_background = bool(task.remove_background)
 
         # 构建正向提示词（加触发词）
         positive = f"{trigger_words}, {task_prompt}" if trigger_words else task_prompt
 
-        # img2img: 准备参考图
+        # img2img: 准备参考图（按内容哈希硬链接到 ComfyUI input）
         input_image_name: str | None = None
         if task_type == "img2img" and task_input_image:
-            upload_path = Path(__file__).resolve().parent.parent.parent / task_input_image.lstrip("/")
-            comfyui_input_dir = Path(__file__).resolve().parent.parent.parent / "ComfyUI" / "input"
-            comfyui_input_dir.mkdir(parents=True, exist_ok=True)
-
-            if upload_path.exists():
-                input_image_name = f"ref_{task_id}_{upload_path.name}"
-                dest = comfyui_input_dir / input_image_name
-                shutil.copy2(str(upload_path), str(dest))
-                logger.info("已复制参考图到 ComfyUI input: %s", input_image_name)
+            upload_path = PROJECT_ROOT / task_input_image.lstrip("/")
+            if await fileio.exists(upload_path):
+                input_image_name = await stage_input_image(upload_path)
+                logger.info("参考图已放入 ComfyUI input: %s", input_image_name)
 
         # ControlNet: 准备控制图
         if task_controlnet_config and task_controlnet_config.get("enabled"):
             cn_image = task_controlnet_config.get("image", "")
             if cn_image:
-                cn_filename = cn_image.split("/")[-1] if "/" in cn_image else cn_image
-                cn_upload_path = Path(__file__).resolve().parent.parent.parent / cn_image.lstrip("/")
-                comfyui_input_dir = Path(__file__).resolve().parent.parent.parent / "ComfyUI" / "input"
-                comfyui_input_dir.mkdir(parents=True, exist_ok=True)
-                cn_dest = comfyui_input_dir / cn_filename
-                if cn_upload_path.exists() and not cn_dest.exists():
-                    shutil.copy2(str(cn_upload_path), str(cn_dest))
-                    logger.info("已复制 ControlNet 控制图到 ComfyUI input: %s", cn_filename)
-
-        await progress_hub.broadcast({
-            "kind": "generation",
-            "id": task_id,
-            "status": "running",
-            "current_frame": 0,
-            "total_frames": task_batch_size,
-            "frame_progress": 0.0,
-            "progress": 0.0,
-            "timestamp": _ts(),
-        })
+                cn_upload_path = PROJECT_ROOT / cn_image.lstrip("/")
+                if await fileio.exists(cn_upload_path):
+                    cn_name = await stage_input_image(cn_upload_path)
+                    task_controlnet_config = {**task_controlnet_config, "image": cn_name}
+                    logger.info("ControlNet 控制图已放入 ComfyUI input: %s", cn_name)
+
+                    # 已有缓存的预处理图（预览或之前的任务产出）时直接使用，跳过预处理器节点
+                    cn_type = task_controlnet_config.get("type", "canny")
+                    cached_map = await control_map_cache.lookup(
+                        control_map_key(cn_name, cn_type, controlnet_preprocess_params(cn_type)), 1
+                    )
+                    if cached_map:
+                        map_name = await stage_input_image(cached_map[0])
+                        task_controlnet_config = {
+                            **task_controlnet_config,
+                            "image": map_name,
+                            "preprocessed": True,
+                        }
+                        logger.info("ControlNet 使用缓存的预处理图: %s", map_name)
+
+        sink = ProgressSink(
+            progress_hub,
+            status_writer,
+            kind="generation",
+            task_id=task_id,
+            model=GenerationTask,
+        )
+        await sink.update(
+            0.0,
+            force=True,
+            current_frame=0,
+            total_frames=task_batch_size,
+            frame_progress=0.0,
+        )
 
-        # ---- 2. 批量循环生成 ----
+        # ---- 2. 批量生成 ----
+        # 按 GENERATION_CHUNK_SIZE 切分：chunk 内各帧由同一 prompt 一次渲染（共享模型加载
+        # 与文本编码）；chunk 失败时回退逐帧渲染。
+        # 指定 seed 时第 i 帧使用 seed+i（chunk 内每帧一条采样分支），结果与分块配置无关
+        # 各 chunk 流水线执行：最多 GENERATION_PIPELINE_DEPTH 个 prompt 同时在
+        # ComfyUI 队列中，结果拷贝与数据库更新和后续帧的渲染并行
         total = task_batch_size
-        success_count = 0
+        chunk_size = max(1, min(GENERATION_CHUNK_SIZE, total))
+        frame_seeds = [
+            task_seed + i if task_seed is not None else random.randint(0, 2**32 - 1)
+            for i in range(total)
+        ]
+        frame_paths: dict[int, str] = {}
+        alpha_paths: dict[int, str] = {}
         failed_frames: list[int] = []
-        all_served_paths: list[str] = []
-
-        for i in range(total):
-            if task_seed is not None:
-                frame_seed = task_seed + i
-            else:
-                frame_seed = random.randint(0, 2**32 - 1)
-
-            frame_success = False
-            client_id = str(uuid.uuid4())
-
-            for attempt in range(MAX_RETRIES):
-                try:
-                    workflow = build_flux_workflow(
-                        prompt=positive,
-                        negative_prompt=task_negative_prompt,
-                        seed=frame_seed,
-                        controlnet=task_controlnet_config,
-                        input_image=input_image_name,
-                        lora_name=lora_name,
-                    )
-
-                    prompt_id = await queue_prompt(workflow, client_id=client_id)
-
-                    async def on_progress(pct: float, _frame_idx: int = i) -> None:
-                        await progress_hub.broadcast({
-                            "kind": "generation",
-                            "id": task_id,
-                            "status": "running",
-                            "current_frame": _frame_idx + 1,
-                            "total_frames": total,
-                            "frame_progress": round(pct / 100.0, 2),
-                            "progress": round((_frame_idx + pct / 100.0) / total, 3),
-                            "timestamp": _ts(),
-                        })
+        in_flight = asyncio.Semaphore(max(GENERATION_PIPELINE_DEPTH, 1))
+        done_count = 0
+        # 在途 prompt 的进度（首帧 -> 已渲染的帧数，可为小数）。多个 chunk 流水线并行时
+        # 总进度 = 已完成帧 + 各在途 chunk 之和，并只增不减，避免各 chunk 各自上报导致回退
+        chunk_progress: dict[int, float] = {}
+        reported_progress = 0.0
+        reported_frame = 0
+
+        async def report_progress(current_frame: int, frame_progress: float, *, force: bool = False) -> None:
+            nonlocal reported_progress, reported_frame
+            pct = (done_count + sum(chunk_progress.values())) / total * 100
+            reported_progress = max(reported_progress, min(round(pct, 1), 100.0))
+            reported_frame = max(reported_frame, current_frame)
+            await sink.update(
+                reported_progress,
+                force=force,
+                current_frame=reported_frame,
+                total_frames=total,
+                frame_progress=frame_progress,
+            )
 
+        # 固定 seed 时结果由工作流唯一确定，可查结果缓存；
+        # LoRA 文件可能被重新训练覆盖，其版本一并计入缓存键
+        use_cache = task_seed is not None and result_cache.enabled
+        lora_version = None
+        if use_cache and lora_name:
+            lora_version = await fileio.run(_file_version, COMFYUI_LORA_DIR / Path(lora_name).name)
+
+        async def render(frames: list[int]) -> None:
+            """用一个 prompt 渲染 frames，结果写入 frame_paths。
+
+            指定 seed 时每帧按各自的 seed 分支采样，否则以首帧 seed 做 latent batch。
+            """
+            first = frames[0]
+            workflow = build_flux_workflow(
+                prompt=positive,
+                negative_prompt=task_negative_prompt,
+                seed=frame_seeds[first],
+                controlnet=task_controlnet_config,
+                input_image=input_image_name,
+                lora_name=lora_name,
+                batch_size=len(frames),
+                remove_background=task_remove_background,
+                seeds=[frame_seeds[i] for i in frames] if task_seed is not None else None,
+            )
+            dests = [OUTPUT_DIR / f"{task_id}_{i}.png" for i in frames]
+            # 串接抠图时透明图紧随原图保存（结果缓存中按 原图..., 透明图... 顺序存放）
+            alpha_dests = (
+                [OUTPUT_DIR / f"{task_id}_{i}_rmbg.png" for i in frames]
+                if task_remove_background else []
+            )
+            all_dests = dests + alpha_dests
+
+            def record() -> None:
+                for i, dest in zip(frames, dests):
+                    frame_paths[i] = f"/outputs/{dest.name}"
+                for i, dest in zip(frames, alpha_dests):
+                    alpha_paths[i] = f"/outputs/{dest.name}"
+
+            cache_key: str | None = None
+            if use_cache:
+                cache_key = workflow_fingerprint(workflow, lora_version=lora_version)
+                if await result_cache.get(cache_key, len(all_dests), all_dests):
+                    logger.info("任务 %s 帧 %s 命中结果缓存", task_id, frames)
+                    record()
+                    return
+
+            async def on_progress(pct: float) -> None:
+                chunk_progress[first] = pct / 100.0 * len(frames)
+                await report_progress(done_count + 1, round(pct, 1))
+
+            # 每个 prompt 单独申请 GPU 槽位，高优先级任务和其他生成任务可在其间插入
+            try:
+                async with in_flight, gpu_gate.slot("generation", ("generation", task_id)):
+                    prompt_id = await queue_prompt(workflow)
                     history = await wait_for_completion(
-                        prompt_id, client_id=client_id, on_progress=on_progress, timeout=300
+                        prompt_id, on_progress=on_progress, timeout=300 * len(frames)
                     )
+            finally:
+                chunk_progress.pop(first, None)
 
-                    comfy_paths = extract_image_paths(history)
-                    for src in comfy_paths:
-                        if os.path.exists(src):
-                            out_name = f"{task_id}_{i}.png"
-                            dest = OUTPUT_DIR / out_name
-                            shutil.copy2(src, str(dest))
-                            all_served_paths.append(f"/outputs/{out_name}")
-
-                    if not comfy_paths:
-                        raise RuntimeError(f"帧 {i} 未产出图片 (prompt_id={prompt_id})")
-
-                    success_count += 1
-                    frame_success = True
-                    break
+            error = extract_error(history)
+            if error:
+                raise RuntimeError(error)
 
+            images, alpha_images = split_flux_outputs(workflow, history)
+            if len(images) < len(frames):
+                raise RuntimeError(
+                    f"帧 {frames} 仅产出 {len(images)} 张图片 (prompt_id={prompt_id})"
+                )
+            if len(alpha_images) < len(alpha_dests):
+                raise RuntimeError(
+                    f"帧 {frames} 仅产出 {len(alpha_images)} 张抠图结果 (prompt_id={prompt_id})"
+                )
+            # 各帧结果并发保存（复制或经 /view 下载）
+            await asyncio.gather(*(
+                save_output_image(history, image, dest)
+                for image, dest in zip(images[:len(dests)] + alpha_images, all_dests)
+            ))
+            record()
+            if cache_key is not None:
+                await result_cache.put(cache_key, all_dests)
+
+        async def run_chunk(frames: list[int]) -> None:
+            nonlocal done_count
+
+            chunk_ok = False
+            if len(frames) > 1:
+                try:
+                    await render(frames)
+                    chunk_ok = True
                 except Exception as e:
-                    logger.warning("任务 %s 帧 %d 第 %d 次尝试失败: %s", task_id, i, attempt + 1, e)
-                    if attempt < MAX_RETRIES - 1:
-                        await _clear_gpu_cache()
-                        await asyncio.sleep(1)
+                    logger.warning("任务 %s 帧 %s 批量渲染失败，回退逐帧: %s", task_id, frames, e)
+                    await gpu_cache_policy.after_failure(e)
+
+            if not chunk_ok:
+                for i in frames:
+                    for attempt in range(MAX_RETRIES):
+                        try:
+                            await render([i])
+                            break
+                        except Exception as e:
+                            logger.warning("任务 %s 帧 %d 第 %d 次尝试失败: %s", task_id, i, attempt + 1, e)
+                            if attempt < MAX_RETRIES - 1:
+                                await gpu_cache_policy.after_failure(e)
+                                await asyncio.sleep(1)
+                    else:
+                        failed_frames.append(i)
+                        logger.error("任务 %s 帧 %d 在 %d 次重试后仍失败", task_id, i, MAX_RETRIES)
+
+            done_count += len(frames)
+            await report_progress(done_count, 100.0, force=True)
+            # 部分结果经合并写入器落库，任务未结束时即可查询
+            status_writer.update(
+                GenerationTask,
+                task_id,
+                output_paths=[frame_paths[i] for i in sorted(frame_paths)],
+            )
 
-            if not frame_success:
-                failed_frames.append(i)
-                logger.error("任务 %s 帧 %d 在 %d 次重试后仍失败", task_id, i, MAX_RETRIES)
+            if done_count < total:
+                await gpu_cache_policy.maybe_free()
 
-            await progress_hub.broadcast({
-                "kind": "generation",
-                "id": task_id,
-                "status": "running",
-                "current_frame": i + 1,
-                "total_frames": total,
-                "frame_progress": 1.0,
-                "progress": round((i + 1) / total, 3),
-                "timestamp": _ts(),
-            })
+        await asyncio.gather(*(
+            run_chunk(list(range(start, min(start + chunk_size, total))))
+            for start in range(0, total, chunk_size)
+        ))
 
-            if i < total - 1:
-                await _clear_gpu_cache()
+        success_count = len(frame_paths)
+        all_served_paths = [frame_paths[i] for i in sorted(frame_paths)]
 
         # ---- 3. 确定最终状态 ----
         if success_count == total:
@@ -442,30 +715,40 @@ async def _generation_task_worker(
         else:
             final_status = "failed"
 
-        # ---- 4. 更新数据库 ----
-        async with session_maker() as session:
-            result = await session.execute(
-                select(GenerationTask).where(GenerationTask.id == task_id)
+        # ---- 4. 更新数据库（与尚未刷新的部分结果合并后立即写入） ----
+        await status_writer.commit(
+            GenerationTask,
+            task_id,
+            status=final_status,
+            progress=100.0,
+            output_paths=all_served_paths,
+        )
+
+        # ---- 5. 串接抠图的透明图记录为关联的抠图任务 ----
+        remove_bg_batch_id: int | None = None
+        if alpha_paths:
+            remove_bg_batch_id = await _link_remove_bg_outputs(
+                session_maker,
+                task_id=task_id,
+                pairs=[(frame_paths[i], alpha_paths[i]) for i in sorted(alpha_paths)],
             )
-            task = result.scalar_one_or_none()
-            if not task:
-                return
-            task.status = final_status
-            task.output_paths = all_served_paths
-            await session.commit()
 
-        # ---- 5. 广播最终状态 ----
-        await progress_hub.broadcast({
+        # ---- 6. 广播最终状态 ----
+        final_event = {
             "kind": "generation",
             "id": task_id,
             "status": final_status,
             "current_frame": total,
             "total_frames": total,
-            "frame_progress": 1.0,
-            "progress": 1.0,
+            "frame_progress": 100.0,
+            "progress": 100.0,
             "output_paths": all_served_paths,
             "timestamp": _ts(),
-        })
+        }
+        if remove_bg_batch_id is not None:
+            final_event["alpha_paths"] = [alpha_paths[i] for i in sorted(alpha_paths)]
+            final_event["remove_bg_batch_id"] = remove_bg_batch_id
+        await progress_hub.broadcast(final_event)
 
         if failed_frames:
             logger.warning("任务 %s 完成，失败帧: %s", task_id, failed_frames)
@@ -489,6 +772,40 @@ async def _generation_task_worker(
         })
 
 
+async def _link_remove_bg_outputs(
+    session_maker: async_sessionmaker,
+    *,
+    task_id: int,
+    pairs: list[tuple[str, str]],
+) -> int:
+    """为生成时串接抠图产出的 (原图, 透明图) 创建已完成的抠图任务行，返回批次 id。
+
+    各行以批次形式关联（batch_id 取首行 id，source_task_id 为生成任务），
+    可通过 /api/remove-bg/batch/{batch_id} 或抠图任务列表查询。
+    """
+    now = datetime.now(timezone.utc)
+    async with session_maker() as session:
+        rows = [
+            BackgroundRemovalTask(
+                input_image=raw,
+                output_image=alpha,
+                model=DEFAULT_REMOVE_BG_MODEL,
+                status="completed",
+                progress=100.0,
+                source_task_id=task_id,
+                completed_at=now,
+            )
+            for raw, alpha in pairs
+        ]
+        session.add_all(rows)
+        await session.flush()
+        batch_id = rows[0].id
+        for row in rows:
+            row.batch_id = batch_id
+        await session.commit()
+    return batch_id
+
+
 # ---------------------------------------------------------------------------
 #  Background removal worker — calls ComfyUI with BiRefNet
 # ---------------------------------------------------------------------------
@@ -509,75 +826,75 @@ async def _remove_bg_worker(
             task = result.scalar_one_or_none()
             if not task:
                 return
-            task.status = "running"
-            await session.commit()
+            batch_id = task.batch_id
             input_image = task.input_image
+            model = task.model
 
-        await progress_hub.broadcast({
-            "kind": "remove_bg",
-            "id": task_id,
-            "status": "running",
-            "progress": 0.0,
-            "timestamp": _ts(),
-        })
+        if batch_id is not None:
+            await _remove_bg_batch_worker(
+                session_maker=session_maker, progress_hub=progress_hub, batch_id=batch_id
+            )
+            return
+        if not await _claim(session_maker, BackgroundRemovalTask, BackgroundRemovalTask.id == task_id):
+            return
+
+        sink = ProgressSink(
+            progress_hub,
+            status_writer,
+            kind="remove_bg",
+            task_id=task_id,
+            model=BackgroundRemovalTask,
+        )
+        await sink.update(0.0, force=True)
 
         # 准备图片到 ComfyUI input 目录
-        upload_path = Path(__file__).resolve().parent.parent.parent / input_image.lstrip("/")
-        comfyui_input_dir = Path(__file__).resolve().parent.parent.parent / "ComfyUI" / "input"
-        comfyui_input_dir.mkdir(parents=True, exist_ok=True)
-
-        image_name = f"rmbg_{task_id}_{upload_path.name}"
-        dest = comfyui_input_dir / image_name
-        shutil.copy2(str(upload_path), str(dest))
+        upload_path = PROJECT_ROOT / input_image.lstrip("/")
+        image_name = await stage_input_image(upload_path)
 
         # 构建并执行工作流
-        workflow = build_remove_bg_workflow(image_name=image_name)
-        client_id = str(uuid.uuid4())
-        prompt_id = await queue_prompt(workflow, client_id=client_id)
+        workflow = build_remove_bg_workflow(image_name=image_name, model=model)
 
         async def on_progress(pct: float) -> None:
-            await progress_hub.broadcast({
-                "kind": "remove_bg",
-                "id": task_id,
-                "status": "running",
-                "progress": round(pct / 100.0, 2),
-                "timestamp": _ts(),
-            })
+            await sink.update(round(pct, 1))
 
-        history = await wait_for_completion(
-            prompt_id, client_id=client_id, on_progress=on_progress, timeout=120
-        )
+        async with gpu_gate.slot("remove_bg", ("remove_bg", task_id)):
+            started = time.monotonic()
+            prompt_id = await queue_prompt(workflow)
+            history = await wait_for_completion(
+                prompt_id, on_progress=on_progress, timeout=120
+            )
+            elapsed = time.monotonic() - started
+
+        error = extract_error(history)
+        if error:
+            raise RuntimeError(error)
+        remove_bg_latency.record(model, elapsed)
 
-        comfy_paths = extract_image_paths(history)
-        if not comfy_paths:
+        images = output_images(history)
+        if not images:
             raise RuntimeError("BiRefNet 未产出结果图片")
 
-        # 复制到 outputs/
-        src = comfy_paths[0]
+        # 保存到 outputs/
         out_name = f"rmbg_{task_id}.png"
-        out_path = OUTPUT_DIR / out_name
-        if os.path.exists(src):
-            shutil.copy2(src, str(out_path))
+        await save_output_image(history, images[0], OUTPUT_DIR / out_name)
 
         served_path = f"/outputs/{out_name}"
 
-        # 更新数据库
-        async with session_maker() as session:
-            result = await session.execute(
-                select(BackgroundRemovalTask).where(BackgroundRemovalTask.id == task_id)
-            )
-            task = result.scalar_one_or_none()
-            if task:
-                task.status = "completed"
-                task.output_image = served_path
-                task.completed_at = datetime.now(timezone.utc)
-                await session.commit()
+        # 更新数据库（与尚未刷新的进度合并后立即写入）
+        await status_writer.commit(
+            BackgroundRemovalTask,
+            task_id,
+            status="completed",
+            progress=100.0,
+            output_image=served_path,
+            completed_at=datetime.now(timezone.utc),
+        )
 
         await progress_hub.broadcast({
             "kind": "remove_bg",
             "id": task_id,
             "status": "completed",
-            "progress": 1.0,
+            "progress": 100.0,
             "output_paths": [served_path],
             "timestamp": _ts(),
         })
@@ -599,3 +916,202 @@ async def _remove_bg_worker(
             "error": str(exc),
             "timestamp": _ts(),
         })
+
+
+async def _remove_bg_batch_worker(
+    *,
+    session_maker: async_sessionmaker,
+    progress_hub: ProgressHub,
+    batch_id: int,
+) -> None:
+    """批量背景移除 worker。
+
+    批次内未完成的图片按 REMOVE_BG_CHUNK_SIZE 分块，每块一个 prompt
+    （BiRefNet 只加载一次、一次排队往返）；块失败时回退逐张处理。
+    各行结果经合并写入器落库，进度以 kind=remove_bg_batch、id=batch_id 汇总推送。
+    """
+    try:
+        # 一条 UPDATE 认领批次内全部 queued 行；running 的行即本次认领的
+        # （中断残留的 running 行在成为调度进程时已重置为 queued）
+        if not await _claim(
+            session_maker, BackgroundRemovalTask, BackgroundRemovalTask.batch_id == batch_id
+        ):
+            return
+        async with session_maker() as session:
+            result = await session.execute(
+                select(BackgroundRemovalTask)
+                .where(BackgroundRemovalTask.batch_id == batch_id)
+                .order_by(BackgroundRemovalTask.id)
+            )
+            rows = list(result.scalars().all())
+            if not rows:
+                return
+            statuses = {row.id: row.status for row in rows}
+            outputs = {row.id: row.output_image for row in rows if row.status == "completed"}
+            pending = [row for row in rows if row.status == "running"]
+            inputs = {row.id: row.input_image for row in rows}
+            models = {row.id: row.model for row in rows}
+            pending_ids = [row.id for row in pending]
+
+        total = len(pending_ids)
+        done = 0
+        sink = ProgressSink(
+            progress_hub,
+            status_writer,
+            kind="remove_bg_batch",
+            task_id=batch_id,
+            model=None,
+        )
+        await sink.update(0.0, force=True, done=0, total=total)
+
+        def finish(row_id: int, served_path: str | None) -> None:
+            if served_path is None:
+                statuses[row_id] = "failed"
+                status_writer.update(BackgroundRemovalTask, row_id, status="failed")
+                return
+            statuses[row_id] = "completed"
+            outputs[row_id] = served_path
+            status_writer.update(
+                BackgroundRemovalTask,
+                row_id,
+                status="completed",
+                progress=100.0,
+                output_image=served_path,
+                completed_at=datetime.now(timezone.utc),
+            )
+
+        # 准备全部图片到 ComfyUI input；文件不存在等错误只影响对应的行
+        async def stage(row_id: int) -> str | None:
+            try:
+                return await stage_input_image(PROJECT_ROOT / inputs[row_id].lstrip("/"))
+            except Exception as e:
+                logger.warning("抠图批次 %s 图片 %s 准备失败: %s", batch_id, inputs[row_id], e)
+                return None
+
+        staged = await asyncio.gather(*(stage(row_id) for row_id in pending_ids))
+        # 按模型分组：同一 prompt 只用一个模型，同模型的块依次提交
+        by_model: dict[str, list[tuple[int, str]]] = {}
+        for row_id, image_name in zip(pending_ids, staged):
+            if image_name is None:
+                finish(row_id, None)
+                done += 1
+            else:
+                by_model.setdefault(models[row_id], []).append((row_id, image_name))
+
+        async def render(model: str, chunk: list[tuple[int, str]]) -> None:
+            """用一个 prompt 处理 chunk；整体失败时抛出，单张缺少输出时记为失败。"""
+            workflow = build_remove_bg_batch_workflow(
+                image_names=[name for _, name in chunk], model=model
+            )
+
+            async def on_progress(pct: float) -> None:
+                await sink.update(
+                    round((done + pct / 100.0 * len(chunk)) / total * 100, 1),
+                    done=done,
+                    total=total,
+                )
+
+            async with gpu_gate.slot("remove_bg", ("remove_bg_batch", batch_id)):
+                started = time.monotonic()
+                prompt_id = await queue_prompt(workflow)
+                history = await wait_for_completion(
+                    prompt_id, on_progress=on_progress, timeout=120 * len(chunk)
+                )
+                elapsed = time.monotonic() - started
+
+            error = extract_error(history)
+            if error:
+                raise RuntimeError(error)
+            remove_bg_latency.record(model, elapsed, len(chunk))
+
+            images = remove_bg_batch_outputs(history, len(chunk))
+
+            async def save(row_id: int, image: dict | None) -> None:
+                if image is None:
+                    logger.warning("抠图批次 %s 任务 %s 未产出结果图片", batch_id, row_id)
+                    finish(row_id, None)
+                    return
+                out_name = f"rmbg_{row_id}.png"
+                try:
+                    await save_output_image(history, image, OUTPUT_DIR / out_name)
+                except Exception as e:
+                    logger.warning("抠图批次 %s 任务 %s 保存结果失败: %s", batch_id, row_id, e)
+                    finish(row_id, None)
+                    return
+                finish(row_id, f"/outputs/{out_name}")
+
+            await asyncio.gather(*(save(row_id, image) for (row_id, _), image in zip(chunk, images)))
+
+        async def run_chunk(model: str, chunk: list[tuple[int, str]]) -> None:
+            nonlocal done
+            try:
+                await render(model, chunk)
+            except Exception as e:
+                if len(chunk) == 1:
+                    logger.warning("抠图批次 %s 任务 %s 失败: %s", batch_id, chunk[0][0], e)
+                    finish(chunk[0][0], None)
+                else:
+                    logger.warning("抠图批次 %s 分块处理失败，回退逐张: %s", batch_id, e)
+                    await gpu_cache_policy.after_failure(e)
+                    for item in chunk:
+                        try:
+                            await render(model, [item])
+                        except Exception as e:
+                            logger.warning("抠图批次 %s 任务 %s 失败: %s", batch_id, item[0], e)
+                            finish(item[0], None)
+            done += len(chunk)
+            await sink.update(round(done / total * 100, 1), force=True, done=done, total=total)
+
+        chunk_size = max(1, REMOVE_BG_CHUNK_SIZE)
+        await asyncio.gather(*(
+            run_chunk(model, items[start:start + chunk_size])
+            for model, items in by_model.items()
+            for start in range(0, len(items), chunk_size)
+        ))
+        await status_writer.flush()
+
+        final_status = remove_bg_batch_status(list(statuses.values()))
+        await progress_hub.broadcast({
+            "kind": "remove_bg_batch",
+            "id": batch_id,
+            "status": final_status,
+            "progress": 100.0,
+            "done": total,
+            "total": total,
+            "output_paths": [outputs[row.id] for row in rows if row.id in outputs],
+            "results": [
+                {
+                    "id": row.id,
+                    "input_image": row.input_image,
+                    "output_image": outputs.get(row.id),
+                    "status": statuses[row.id],
+                }
+                for row in rows
+            ],
+            "timestamp": _ts(),
+        })
+
+    except Exception as exc:
+        logger.exception("Remove-bg batch %s failed", batch_id)
+        # 先写入已完成行的结果，再把其余未完成的行标记为失败
+        try:
+            await status_writer.flush()
+        except Exception:
+            logger.exception("抠图批次 %s 写入结果失败", batch_id)
+        async with session_maker() as session:
+            await session.execute(
+                update(BackgroundRemovalTask)
+                .where(
+                    BackgroundRemovalTask.batch_id == batch_id,
+                    BackgroundRemovalTask.status.in_(("queued", "running")),
+                )
+                .values(status="failed")
+            )
+            await session.commit()
+        await progress_hub.broadcast({
+            "kind": "remove_bg_batch",
+            "id": batch_id,
+            "status": "failed",
+            "error": str(exc),
+            "timestamp": _ts(),
+        })
@@ -1,4 +1,4 @@
-import { useEffect, useMemo } from 'react';
+import { useEffect } from 'react';
 import {
   Table,
   Tag,
@@ -30,21 +30,12 @@ const kindLabels: Record<string, { label: string; color: string; icon: React.Rea
 };
 
 export default function HistoryPage() {
-  const { tasks, loading, filter, fetchTasks, setFilter } = useTaskStore();
+  const { tasks, nextCursor, loading, filter, fetchTasks, loadMore, setFilter } = useTaskStore();
 
   useEffect(() => {
     fetchTasks();
   }, [fetchTasks]);
 
-  // 过滤逻辑
-  const filteredTasks = useMemo(() => {
-    return tasks.filter((t) => {
-      if (filter.kind !== 'all' && t.task_kind !== filter.kind) return false;
-      if (filter.status !== 'all' && t.status !== filter.status) return false;
-      return true;
-    });
-  }, [tasks, filter]);
-
   const columns: ColumnsType<TaskListItem> = [
     {
       title: 'ID',
@@ -187,17 +178,26 @@ export default function HistoryPage() {
       {/* 任务表格 */}
       <Table
         columns={columns}
-        dataSource={filteredTasks}
+        dataSource={tasks}
         rowKey={(r) => `${r.task_kind}-${r.id}`}
         loading={loading}
         pagination={{
           pageSize: 20,
           showSizeChanger: true,
-          showTotal: (total) => `共 ${total} 条记录`,
+          showTotal: (total) => (nextCursor ? `已加载 ${total} 条记录` : `共 ${total} 条记录`),
         }}
         size="middle"
         className={styles.table}
       />
+
+      {/* 服务端分页：还有更早的任务时继续加载 */}
+      {nextCursor && (
+        <div className={styles.loadMore}>
+          <Button onClick={loadMore} loading={loading}>
+            加载更多
+          </Button>
+        </div>
+      )}
     </div>
   );
 }
@@ -566,7 +566,7 @@ export function GenerationPanel() {
                 生成中 {currentFrame}/{totalFrames}
               </Text>
               <Progress
-                percent={Math.round(frameProgress * 100)}
+                percent={Math.round(frameProgress)}
                 size="small"
                 showInfo={false}
                 strokeColor="#8b5cf6"
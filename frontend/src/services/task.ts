@@ -1,8 +1,24 @@
 import type { TaskListItem } from '@/types';
 import api from './api';
 
-/** 获取所有任务列表（训练 + 生成） */
-export async function fetchTasks(): Promise<TaskListItem[]> {
-  const { data } = await api.get<TaskListItem[]>('/api/tasks');
-  return data;
+/** 任务列表的一页，nextCursor 为 null 表示没有更多 */
+export interface TaskPage {
+  items: TaskListItem[];
+  nextCursor: string | null;
+}
+
+/** 任务列表查询参数：kind / status 为服务端过滤条件，翻页时需与首页保持一致 */
+export interface TaskQuery {
+  kind?: TaskListItem['task_kind'];
+  status?: string;
+  cursor?: string | null;
+}
+
+/** 获取任务列表（训练 + 生成 + 抠图），按创建时间倒序分页，下一页游标来自 X-Next-Cursor 响应头 */
+export async function fetchTasks(query: TaskQuery = {}): Promise<TaskPage> {
+  const { kind, status, cursor } = query;
+  const { data, headers } = await api.get<TaskListItem[]>('/api/tasks', {
+    params: { kind, status, cursor: cursor || undefined },
+  });
+  return { items: data, nextCursor: headers['x-next-cursor'] ?? null };
 }
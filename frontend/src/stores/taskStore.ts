@@ -1,10 +1,12 @@
 import { create } from 'zustand';
 import type { TaskListItem } from '@/types';
-import { fetchTasks } from '@/services/task';
+import { fetchTasks, type TaskQuery } from '@/services/task';
 
 interface TaskStore {
   /** 任务列表 */
   tasks: TaskListItem[];
+  /** 下一页游标（null 表示已加载全部） */
+  nextCursor: string | null;
   /** 加载中 */
   loading: boolean;
   /** 错误 */
@@ -17,28 +19,65 @@ interface TaskStore {
 
   // Actions
   fetchTasks: () => Promise<void>;
+  loadMore: () => Promise<void>;
   setFilter: (filter: Partial<TaskStore['filter']>) => void;
   clearError: () => void;
 }
 
-export const useTaskStore = create<TaskStore>((set) => ({
+/** 把筛选条件转换为服务端查询参数（'all' 表示不过滤） */
+function filterQuery(filter: TaskStore['filter']): TaskQuery {
+  return {
+    kind: filter.kind === 'all' ? undefined : filter.kind,
+    status: filter.status === 'all' ? undefined : filter.status,
+  };
+}
+
+// 每次重新加载递增；筛选条件变化后，旧请求的结果直接丢弃
+let requestSeq = 0;
+
+export const useTaskStore = create<TaskStore>((set, get) => ({
   tasks: [],
+  nextCursor: null,
   loading: false,
   error: null,
   filter: { kind: 'all', status: 'all' },
 
   fetchTasks: async () => {
+    const seq = ++requestSeq;
+    set({ loading: true, error: null });
+    try {
+      const page = await fetchTasks(filterQuery(get().filter));
+      if (seq !== requestSeq) return;
+      set({ tasks: page.items, nextCursor: page.nextCursor, loading: false });
+    } catch (e) {
+      if (seq !== requestSeq) return;
+      set({ loading: false, error: (e as Error).message });
+    }
+  },
+
+  loadMore: async () => {
+    const { nextCursor, loading, filter } = get();
+    if (!nextCursor || loading) return;
+    const seq = requestSeq;
     set({ loading: true, error: null });
     try {
-      const tasks = await fetchTasks();
-      set({ tasks, loading: false });
+      const page = await fetchTasks({ ...filterQuery(filter), cursor: nextCursor });
+      if (seq !== requestSeq) return;
+      set((s) => ({
+        tasks: [...s.tasks, ...page.items],
+        nextCursor: page.nextCursor,
+        loading: false,
+      }));
     } catch (e) {
+      if (seq !== requestSeq) return;
       set({ loading: false, error: (e as Error).message });
     }
   },
 
   setFilter: (filter) => {
-    set((s) => ({ filter: { ...s.filter, ...filter } }));
+    // 过滤在服务端执行：条件变化后清空已加载的页并从第一页重新加载
+    set((s) => ({ filter: { ...s.filter, ...filter }, tasks: [], nextCursor: null }));
+    get().fetchTasks();
   },
 
   clearError: () => set({ error: null }),
@@ -3,9 +3,11 @@ export interface WSProgressMessage {
   kind: 'generation' | 'training' | 'remove_bg';
   id: number;
   status: string;
+  /** 进度百分比 0~100（各类任务一致） */
   progress?: number;
   current_frame?: number;
   total_frames?: number;
+  /** 当前帧进度百分比 0~100 */
   frame_progress?: number;
   output_paths?: string[];
   timestamp?: string;